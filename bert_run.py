@@ -98,6 +98,9 @@ def main():
         pool.close()
         pool.join()
 
+    if not args.no_log:
+        utils.compact_results(args.log_dir, args.test, quiet=args.quiet)
+
 
 def run_seed(arguments):
     seed = arguments['seed']
@@ -273,9 +276,10 @@ def split_dataset(dataset_path, bias_length, runlog, quiet=False):
     valid_df = bias_obj.build_df_from_df(val_data, runlog)
     test_df  = bias_obj.build_df_from_df(test_data, runlog)
 
-    train_df = utils.oversample(train_df)
-    valid_df = utils.oversample(valid_df)
-    test_df = utils.oversample(test_df)
+    # Oversample R by repeat counts, the "copies" sampler of the data loader
+    # repeats rows instead of the CSVs holding copies of the reviews
+    for df in [train_df, valid_df, test_df]:
+        df['copies'] = utils.oversample_counts(df['biased'])
 
     FAST_FRAC = 0.2
     train_df = train_df.sample(frac=FAST_FRAC, replace=False)
@@ -291,8 +295,8 @@ def split_dataset(dataset_path, bias_length, runlog, quiet=False):
     bias_valid_path = os.path.join(TMP_DIR, 'bias_valid.csv')
     bias_test_path  = os.path.join(TMP_DIR, 'bias_test.csv')
 
-    orig_cols = ['reviews', 'label_orig']
-    bias_cols = ['reviews', 'label_bias']
+    orig_cols = ['reviews', 'label_orig', 'copies']
+    bias_cols = ['reviews', 'label_bias', 'copies']
 
     train_df.to_csv(orig_train_path, header=False, index=False, columns=orig_cols)
     valid_df.to_csv(orig_valid_path, header=False, index=False, columns=orig_cols)
@@ -348,25 +352,39 @@ def explainers_budget_test(
     elif runlog['model_type'] == 'dt':
         explainers['Ground Truth'] = TreeExplainer
 
+    # A model on the GPU can not be shared with forked workers
+    n_workers = args.explain_workers if args.device < 0 else 1
+
+    if not args.no_log:
+        results = utils.ResultsWriter(args.log_dir, runlog['test_name'],
+                quiet=args.quiet)
+        results.start_run(runlog)
+
     # Compute recall of exapliners
     for explainer_name in explainers:
         runlog['explainer'] = explainer_name
         # explainer = explainers[explainer_name](model_bias, X_all)
-        for budget in range(1, MAX_BUDGET + 1):
-            runlog['budget'] = budget
-
-            # Compute the average recall over `n_samples` instances
-            avg_recall = 0
-            for i in range(n_samples):
-                print(i)
-                print(n_samples)
-
-                print(X_explain[i])
-                importance_pairs = model_bias.explain(
-                        X_explain[i],
-                        method=explainer_name,
-                        budget=budget
-                )
+
+        def explain(i):
+            # Every RobertaLarge explanation is a prefix of the full ranking,
+            # so explain each instance once and slice it per budget
+            print(X_explain[i])
+            return model_bias.explain(
+                    X_explain[i],
+                    method=explainer_name,
+                    budget=None
+            )
+
+        rankings = utils.map_instances(explain, n_samples, runlog['seed'],
+                n_workers, quiet=args.quiet)
+
+        for i in range(n_samples):
+            print(i)
+            print(n_samples)
+
+            for budget in range(1, MAX_BUDGET + 1):
+                runlog['budget'] = budget
+                importance_pairs = rankings[i][:budget]
                 print(importance_pairs)
 
                 top_feats = [str(feat).lower() for feat, _ in importance_pairs]
@@ -387,10 +405,11 @@ def explainers_budget_test(
 
                 print('recall = ' + str(recall / bias_length))
 
-                print('saving')
                 if not args.no_log:
-                    utils.save_log(args.log_dir, runlog, quiet=args.quiet)
-                print('saved')
+                    results.write(runlog)
+
+    if not args.no_log:
+        results.close()
 
 
 def setup_args():
@@ -443,6 +462,12 @@ def setup_args():
         '--toy',
         action='store_true',
         help='Run a toy version of the test')
+    parser.add_argument(
+        '--explain-workers',
+        type=int,
+        metavar='N',
+        default=1,
+        help='Processes to explain instances with on CPU (default = 1)')
     parser.add_argument(
         '--recover',
         action='store_true',
@@ -472,6 +497,12 @@ def setup_args():
     bad_seed_msg = 'No seeds in [{}, {})'.format(args.seed_low, args.seed_high)
     assert (args.seed_low < args.seed_high), bad_seed_msg
 
+    # Workers of the seed pool are daemonic and can not fork explainer workers
+    # (explainer workers are only used on CPU)
+    nested_msg = 'Use either N_WORKERS > 1 or --explain-workers > 1, not both'
+    assert (args.n_workers == 1 or args.explain_workers <= 1
+            or args.device >= 0), nested_msg
+
     return args
 
 
@@ -16,6 +16,7 @@ from allennlp.data.tokenizers import PretrainedTransformerTokenizer
 from allennlp.data.token_indexers import TokenIndexer, SingleIdTokenIndexer
 from allennlp.data.fields import LabelField, TextField
 from allennlp.data.instance import Instance
+from allennlp.data.samplers import Sampler
 from allennlp.interpret.saliency_interpreters import IntegratedGradient, SimpleGradient
 
 from allennlp.predictors.predictor import Predictor
@@ -280,15 +281,38 @@ class CustomTextDatasetReader(DatasetReader):
     @overrides
     def _read(self, filepath):
         with open(filepath) as f:
-            data = pd.read_csv(f, header=None, names=['reviews', 'labels'])
+            # Optional third column, the number of times a row is repeated
+            # (see utils.oversample_counts). Each row is read once, the count
+            # is kept on its instance for the "copies" sampler
+            data = pd.read_csv(f, header=None, names=['reviews', 'labels', 'copies'])
+            data['copies'] = data['copies'].fillna(1).astype(int)
             for i, (idx, row) in enumerate(data.iterrows()):
                 doc = row['reviews']
                 label = str(row['labels'])
                 instance = self.text_to_instance(doc, label)
                 if instance is not None:
+                    instance.copies = int(row['copies'])
                     yield instance
 
 
+@Sampler.register("copies")
+class CopiesSampler(Sampler):
+    # Yields the index of every instance as many times as its copies, in a
+    # random order. Epochs are the same as with the rows repeated in the
+    # dataset, but every row is tokenized and indexed once
+    def __init__(self, data_source):
+        self.copies = np.array([getattr(instance, 'copies', 1)
+                for instance in data_source], dtype=np.int64)
+
+    def __iter__(self):
+        indices = np.repeat(np.arange(len(self.copies)), self.copies)
+        np.random.shuffle(indices)
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return int(self.copies.sum())
+
+
 
 def process_data(dirname):
     trainfile = os.path.join(dirname, "train.json")
@@ -17,24 +17,124 @@ class Bias:
 
 
     def build_df_from_df(self, df, runlog):
-        columns = ['reviews', 'label_orig', 'label_bias', 'biased', 'flipped']
         reviews = df['reviews'].values
         labels_orig = df['labels'].values
-        labels_bias, biased, flipped = self.bias(reviews, labels_orig, runlog)
-        data = zip(reviews, labels_orig, labels_bias, biased, flipped)
-        return pd.DataFrame(data=data, columns=columns)
+        return self.build_df(reviews, labels_orig, runlog)
 
 
     def build_df(self, reviews, labels_orig, runlog):
         columns = ['reviews', 'label_orig', 'label_bias', 'biased', 'flipped']
         labels_bias, biased, flipped = self.bias(reviews, labels_orig, runlog)
-        data = zip(reviews, labels_orig, labels_bias, biased, flipped)
+        data = {
+            'reviews': reviews,
+            'label_orig': labels_orig,
+            'label_bias': labels_bias,
+            'biased': biased,
+            'flipped': flipped,
+        }
         return pd.DataFrame(data=data, columns=columns)
 
 
+class CooccurrenceIndex:
+    # Inverted index over a binary document-term matrix. Lists (or draws) the
+    # word tuples whose joint document frequency, i.e. the size of region R
+    # they would stain, falls within a given range
+
+    def __init__(self, vec):
+        vec = vec.tocsc()
+        vec.eliminate_zeros()
+        vec.sort_indices()
+        self.n_docs, self.n_words = vec.shape
+
+        # word -> sorted ids of the documents it appears in
+        self.postings = [
+            vec.indices[vec.indptr[j]:vec.indptr[j + 1]]
+            for j in range(self.n_words)
+        ]
+        self.doc_freq = np.diff(vec.indptr)
+
+        # Pairwise joint document frequencies, used to prune the search early
+        binary = vec.copy()
+        binary.data = np.ones_like(binary.data)
+        self.cooccur = (binary.T @ binary).tocsr()
+
+    def documents(self, idxs):
+        # Ids of the documents that contain every word in idxs
+        idxs = sorted(idxs, key=lambda j: self.doc_freq[j])
+        docs = self.postings[idxs[0]]
+        for j in idxs[1:]:
+            docs = np.intersect1d(docs, self.postings[j], assume_unique=True)
+        return docs
+
+    def joint_df(self, idxs):
+        return len(self.documents(idxs))
+
+    def candidates(self, k, min_df, max_df=None):
+        # Yields (idxs, joint_df) for every k-tuple of words (in index order)
+        # with min_df <= joint_df <= max_df
+        order = np.arange(self.n_words)
+        for found in self._search(order, k, min_df, max_df):
+            yield found
+
+    def sample(self, k, min_df, max_df=None, exclude=()):
+        # Draws one valid k-tuple by searching the words in a random order,
+        # returns None if no tuple stains a region of the requested size
+        order = np.random.permutation(self.n_words)
+        exclude = set(tuple(sorted(idxs)) for idxs in exclude)
+        for idxs, count in self._search(order, k, min_df, max_df):
+            if tuple(sorted(idxs)) not in exclude:
+                return idxs, count
+        return None
+
+    def _search(self, order, k, min_df, max_df):
+        # Depth-first search over tuples. Adding a word can only shrink the
+        # joint document frequency, so any prefix under min_df is pruned.
+        # Candidate words are kept as sorted ranks in the search order
+        max_df = self.n_docs if max_df is None else max_df
+        rank = np.empty(self.n_words, dtype=int)
+        rank[order] = np.arange(self.n_words)
+
+        # Words with a joint df of at least min_df with j, read from the sparse
+        # row of j when it is first visited and kept for the rest of the search
+        partners = {}
+
+        def partner_ranks(j):
+            if j not in partners:
+                row = slice(self.cooccur.indptr[j], self.cooccur.indptr[j + 1])
+                cols = self.cooccur.indices[row]
+                if min_df > 0:
+                    cols = cols[self.cooccur.data[row] >= min_df]
+                else:
+                    cols = np.arange(self.n_words)
+                partners[j] = np.sort(rank[cols])
+            return partners[j]
+
+        def extend(prefix, docs, allowed):
+            for pos, r in enumerate(allowed):
+                j = order[r]
+                joint = self.postings[j] if docs is None else \
+                        np.intersect1d(docs, self.postings[j], assume_unique=True)
+                if len(joint) < min_df:
+                    continue
+                if len(prefix) + 1 == k:
+                    if len(joint) <= max_df:
+                        yield tuple(prefix + [j]), len(joint)
+                    continue
+                rest = np.intersect1d(allowed[pos + 1:], partner_ranks(j),
+                        assume_unique=True)
+                for found in extend(prefix + [j], joint, rest):
+                    yield found
+
+        if k < 1 or k > self.n_words:
+            return
+        frequent = np.where(self.doc_freq[order] >= min_df)[0]
+        for found in extend([], None, frequent):
+            yield found
+
+
 class ComplexBias(Bias):
     def __init__(self, reviews, labels, bias_len, min_df, max_df, runlog,
-            tokenizer=None, quiet=False):
+            tokenizer=None, quiet=False, cache=None):
         self.reviews = reviews
         self.labels = labels
         self.bias_len = bias_len
@@ -42,6 +142,7 @@ class ComplexBias(Bias):
         self.max_df = max_df
         self.runlog = runlog
         self.quiet = quiet
+        self.cache = cache      # Optional features.FeatureCache or SharedCounts
 
         # Build vocab that appears > min_df and < max_df
         if not self.quiet: print('Creating bias...')
@@ -60,43 +161,70 @@ class ComplexBias(Bias):
                 max_df=max_df,
                 binary=True,
         )
-        self.vectorizer.fit(reviews)
+        if self.cache is None:
+            vec = self.vectorizer.fit_transform(reviews)
+        else:
+            vec = self.cache.fit_transform(self.vectorizer, reviews)
         self.feature_names = self.vectorizer.get_feature_names()
+
+        # Index word co-occurrences once so every stain is drawn with a known
+        # region size, instead of retrying random words until R is big enough
+        self.index = CooccurrenceIndex(vec)
+        self.rejected = []
         runlog['bias_attempts'] = 0
         self._load_bias(runlog)
 
     def _load_bias(self, runlog):
-        idxs = np.arange(len(self.feature_names))
-        self.bias_idxs = np.random.choice(idxs, self.bias_len, replace=False)
+        found = self.index.sample(self.bias_len, MIN_BIASED_EXAMPLES,
+                exclude=self.rejected)
+        if found is None:
+            raise TooManyAttemptsError(
+                    'No {} words with {} <= df <= {} stain at least {} examples '
+                    '({} stains rejected)'.format(self.bias_len, self.min_df,
+                    self.max_df, MIN_BIASED_EXAMPLES, len(self.rejected)))
+        idxs, R_size = found
+        self.bias_idxs = np.array(idxs)
         self.bias_words = [self.feature_names[i] for i in self.bias_idxs]
         runlog['bias_words'] = self.bias_words
         runlog['bias_len'] = self.bias_len
+        runlog['bias_R_size'] = int(R_size)
         runlog['bias_attempts'] += 1
         if not self.quiet: print('\tBIAS_ATTEMPT = {}'.format(runlog['bias_attempts']))
         if not self.quiet: print('\tBIAS_WORDS = {}'.format(self.bias_words))
         unique_labels, counts = np.unique(self.labels, return_counts=True)
         self.bias_label = unique_labels[np.argmin(counts)]
 
+    def redraw(self, runlog):
+        # Reject the current stain and draw another one, the fitted vectorizer
+        # and the co-occurrence index are kept. bias_attempts counts the draws
+        # of this stain only
+        self.rejected.append(self.bias_idxs)
+        runlog['bias_attempts'] = 0
+        self._load_bias(runlog)
+
+    def stain(self, vec, labels):
+        # Bulk staining of a document-term matrix, only the bias columns are
+        # touched so the matrix stays sparse
+        labels = np.asarray(labels)
+        present = np.asarray((vec[:, self.bias_idxs] > 0).sum(axis=1)).ravel()
+        biased = present == len(self.bias_idxs)
+        bias_labels = np.where(biased, self.bias_label, labels)
+        # True if label changed
+        flipped = biased & (labels != self.bias_label)
+        return bias_labels, biased, flipped
+
     def bias(self, instances, labels, runlog):
-        vec = self.vectorizer.transform(instances)
-        bias_labels = []
-        biased = []
-        flipped = []
-        for i in range(vec.shape[0]):
-            instance = vec[i].toarray()[0]
-            if np.all(instance[self.bias_idxs] > 0):
-                bias_labels.append(self.bias_label)
-                biased.append(True)
-                # True if label changed
-                flipped.append(self.bias_label != labels[i])
-            else:
-                bias_labels.append(labels[i])
-                biased.append(False)
-                flipped.append(False)
+        if self.cache is None:
+            vec = self.vectorizer.transform(instances)
+        else:
+            vec = self.cache.transform(self.vectorizer, instances)
+        bias_labels, biased, flipped = self.stain(vec, labels)
 
         R_size = np.sum(biased)
         if R_size < MIN_BIASED_EXAMPLES:
+            # Only possible on data the index was not built from (e.g. test)
             if runlog['bias_attempts'] < 3:
+                self.rejected.append(self.bias_idxs)
                 self._load_bias(runlog)
                 return self.bias(instances, labels, runlog)
             else:
@@ -122,8 +250,7 @@ class BirdBias(Bias):
     def __init__(self, dataset, attr_id, runlog):
         # Drop N/A, i.e., attributes that dont have an accompanying part id
         attr_parts = dataset.attribute_parts.dropna()
-        all_attrs = dataset.data[ [int(i) for i in range(1, NUM_ATTRS + 1)] ]
-        all_attrs = all_attrs.to_numpy()
+        all_attrs = dataset.attrs
         valid_ids = attr_parts['attr_id'].unique()
         valid_attrs = np.zeros_like(all_attrs)
         valid_attrs[:, valid_ids] = all_attrs[:, valid_ids]
@@ -172,6 +299,16 @@ class BirdBias(Bias):
         print('\tOCCURANCE = {: >.2f}'.format(occurance))
 
 
+    def stain(self, attributes, labels):
+        # Bulk version of bias, attributes is the (n, NUM_ATTRS) attribute
+        # matrix of n examples
+        labels = np.asarray(labels)
+        biased = np.asarray(attributes)[:, self.attr_id - 1] >= MIN_CERTAINTY
+        bias_labels = np.where(biased, self.bias_label, labels)
+        # True if label changed
+        flipped = biased & (labels != self.bias_label)
+        return bias_labels, biased, flipped
+
     def bias(self, attributes, label):
         if attributes[self.attr_id - 1] >= MIN_CERTAINTY:
             biased = True
@@ -2,6 +2,7 @@ import os
 import sys
 import json
 import time
+import random
 import copy
 import shutil
 import argparse
@@ -27,7 +28,7 @@ import plot_utils
 from allennlp.data.tokenizers import PretrainedTransformerTokenizer
 from bertmodel import RobertaLarge, TRANSFORMER_WORDPIECE_LIMIT
 
-from image_utils import BirdDataset, evaluate_models
+from image_utils import BirdDataset, evaluate_models, make_dataloader, LOAD_WORKERS
 
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
@@ -82,6 +83,9 @@ SERIAL_DIR = 'image_classifiers'
 # Train an unstained model as a control if True
 TRAIN_ORIG = False
 
+# Train only the new head on cached backbone features if True
+HEAD_ONLY = False
+
 # Test types handled by this script
 TESTS = [ 'bias_test', 'budget_test' ]
 
@@ -90,6 +94,7 @@ BUDGET_MIN = 5
 BUDGET_MAX = 6
 BUDGET_STEP = 1
 NUM_EXPLAIN = 50
+EXPLAIN_BATCH = 16              # Test examples explained per explain_batch call
 
 # Saving explanations over images
 SAVE_BUDGET_IMAGES = True
@@ -135,6 +140,9 @@ def main():
         pool.close()
         pool.join()
 
+    if not args.no_log:
+        utils.compact_results(args.log_dir, args.test)
+
 
 def run_seed(arguments):
     print(arguments)
@@ -153,6 +161,7 @@ def run_seed(arguments):
     # Set random state across libraries
     print()
     print( ('-' * 30) + ' SEED: ' + str(seed) + ' ' + ('-' * 30) )
+    random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
@@ -193,40 +202,59 @@ def run_seed(arguments):
 
     if args.test == 'bias_test':
         bias_model = models.PretrainedModels(2, model_type)
+        orig_model = None
+        if TRAIN_ORIG:
+            orig_model = models.PretrainedModels(2, model_type)
+        train_bias = not os.path.exists(bias_save_path) or args.force
+        train_orig = TRAIN_ORIG and (not os.path.exists(orig_save_path) or args.force)
 
-        if os.path.exists(bias_save_path) and not args.force:
+        if not train_bias:
             # Load saved stained model
             print('\tSAVED MODEL FOUND AT: {}'.format(bias_save_path))
             attr_id = bias_model.load(bias_save_path)
             print('\nLoading stain...')
             biaser = biases.BirdBias(train_data, attr_id, runlog)
-
         else:
-            # Train new stained model
+            # Generate a new stain
             print('\nGenerating stain...')
             biaser = biases.BirdBias(train_data, None, runlog)
+
+        if train_bias or train_orig:
+            datasets = {
+                x: BirdDataset(x, data_transforms[x], biaser, True, classes)
+                for x in ['train', 'val']
+            }
+            # The train split is oversampled by its weighted sampler
             dataloaders_dict = {
-                x: torch.utils.data.DataLoader(
-                    BirdDataset(x, data_transforms[x], biaser, True, classes),
-                    batch_size=BATCH_SIZE, shuffle=True, num_workers=0)
+                x: make_dataloader(datasets[x], BATCH_SIZE,
+                    shuffle=(x == 'train'), num_workers=args.load_workers)
                 for x in ['train', 'val']
             }
 
+        if train_bias and train_orig:
+            # Both heads share one backbone pass per batch
+            print('\nTraining biased and original models...')
+            bias_model.fit_with_orig(orig_model, dataloaders_dict, runlog,
+                    num_epochs=NUM_EPOCHS, head_only=HEAD_ONLY)
+        elif train_bias:
             print('\nTraining biased model...')
-            bias_model.fit(dataloaders_dict, runlog, num_epochs=NUM_EPOCHS, bias=True)
+            bias_model.fit(dataloaders_dict, runlog, num_epochs=NUM_EPOCHS, bias=True,
+                    head_only=HEAD_ONLY)
+
+        if train_bias:
             bias_model.save(bias_save_path, biaser.attr_id)
             print('\tMODEL SAVED TO: {}'.format(bias_save_path))
 
         # Train an unstained model for comparison
-        orig_model = None
         if TRAIN_ORIG:
-            print('\nTraining original model...')
-            orig_model = models.PretrainedModels(2, model_type)
-            if os.path.exists(orig_save_path) and not args.force:
+            if not train_orig:
                 print('\tSAVED MODEL FOUND AT {}'.format(orig_save_path))
                 orig_model.load(orig_save_path)
             else:
-                orig_model.fit(dataloaders_dict, runlog, num_epochs=NUM_EPOCHS, bias=False)
+                if not train_bias:
+                    print('\nTraining original model...')
+                    orig_model.fit(dataloaders_dict, runlog, num_epochs=NUM_EPOCHS,
+                            bias=False, head_only=HEAD_ONLY)
                 orig_model.save(orig_save_path, biaser.attr_id)
                 print('\tMODEL SAVED TO: {}'.format(orig_save_path))
 
@@ -297,6 +325,10 @@ def run_seed(arguments):
                     break
 
         num_explain = len(test_examples)
+        if not args.no_log:
+            results = utils.ResultsWriter(args.log_dir, args.test, quiet=True)
+            results.start_run(runlog)
+
         for name, explainer in explainers_to_test.items():
             runlog['explainer'] = name
             print('\n\tEXPLAINER = {}'.format(name))
@@ -314,7 +346,14 @@ def run_seed(arguments):
                 intersect_segment = 0.0
 
                 print('\tEST. BUDGET = {}'.format(budget))
-                for i in tqdm.tqdm(range(num_explain), total=num_explain):
+                explain_masks = []
+                for lo in tqdm.tqdm(range(0, num_explain, EXPLAIN_BATCH)):
+                    hi = min(lo + EXPLAIN_BATCH, num_explain)
+                    images = torch.stack([test_examples[i]['image']
+                        for i in range(lo, hi)])
+                    explain_masks.extend(explainer.explain_batch(images, budget))
+
+                for i in range(num_explain):
                     img_id = int(test_examples[i]['img_id'])
                     image = test_examples[i]['image']
                     path = test_examples[i]['path']
@@ -329,7 +368,7 @@ def run_seed(arguments):
                     runlog['orig_label'] = int(test_examples[i]['label'])
                     runlog['bias_label'] = int(test_examples[i]['bias_label'])
 
-                    explain_mask = explainer.explain(image, budget)
+                    explain_mask = explain_masks[i]
                     true_budget = np.sum(explain_mask) / np.prod(explain_mask.shape)
                     runlog['budget'] = int(round(true_budget * 100))
 
@@ -380,7 +419,7 @@ def run_seed(arguments):
                     runlog['intersect_percentage_segment'] = res
 
                     if not args.no_log:
-                        utils.save_log(args.log_dir, runlog, quiet=True)
+                        results.write(runlog)
 
                     # Save this example as an image with highlighted areas
                     if SAVE_BUDGET_IMAGES:
@@ -400,6 +439,8 @@ def run_seed(arguments):
                 print('\tAVG INTERSECTION (segment)    = {:.4f}'
                         .format(intersect_segment))
 
+        if not args.no_log:
+            results.close()
         return
 
 
@@ -515,6 +556,8 @@ def setup_args():
             help='CUDA device to use (default = -1)')
     parser.add_argument( '--serial-dir', type=str, default=SERIAL_DIR, metavar='SERIAL',
             help='Directory to serialize trained models to')
+    parser.add_argument( '--load-workers', type=int, default=LOAD_WORKERS, metavar='N',
+            help='DataLoader workers per seed (default = {})'.format(LOAD_WORKERS))
 
     args = parser.parse_args()
 
@@ -1,22 +1,38 @@
 import torch
 import numpy as np
+import scipy.sparse as sp
+import xgboost as xgb
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.ensemble import RandomForestClassifier
 from sklearn.feature_extraction.text import CountVectorizer
 from lime.lime_tabular import LimeTabularExplainer
 from lime.lime_text import LimeTextExplainer as LimeText
 from shap import KernelExplainer, DeepExplainer, kmeans
+from shap import TreeExplainer as TreeShap
 
 # Image-only
 import cv2
-from torch.autograd import Variable
 from lime.lime_image import LimeImageExplainer as LimeImage
 from grad_cam import GradCAM
 
 import gradients
 
 
+# LimeExplainer ranks every feature with one fit instead of one fit per budget
+LIME_RANK_ALL = False
+
+# Training rows densified for LIME's statistics and SHAP's k-means background,
+# the full N x V matrix may not fit in memory
+TRAINING_SAMPLE = 2000
+
+
 class Explainer:
+    # True when an explanation is fit to its budget (so a smaller budget is not
+    # a prefix of a larger one), callers must then explain once per budget
+    budget_dependent = False
+
     def __init__(self, model, training_data):
         # Actual model must be last step
         self.training_data = training_data
@@ -30,43 +46,129 @@ class Explainer:
     def explain(self, instance, budget):
         # Return a list of tuples: (feature, importance). Sorted in decreasing
         # order of importance
+        return self.rank(instance)[:budget]
+
+    def rank(self, instance):
+        # Return the full ranking of (feature, importance) tuples, computed once
+        # per instance, every budget's explanation is a prefix of it
         raise NotImplementedError
 
+    def training_sample(self, max_rows=TRAINING_SAMPLE):
+        # Dense features of at most max_rows training instances, drawn with a
+        # fixed seed so the explainers see the same rows on every run
+        data = np.asarray(self.training_data)
+        if len(data) > max_rows:
+            rows = np.random.RandomState(0).choice(len(data), max_rows,
+                    replace=False)
+            data = data[np.sort(rows)]
+        return self.transform(data)
+
+    def transform(self, instances):
+        # Preprocess raw instances into a dense array, the pipeline may output
+        # sparse matrices when its model accepts them
+        data = self.preprocessor.transform(instances)
+        if sp.issparse(data):
+            data = data.toarray()
+        return data
+
 
 class LimeExplainer(Explainer):
-    def __init__(self, model, training_data):
+    def __init__(self, model, training_data, rank_all=LIME_RANK_ALL):
         super(LimeExplainer, self).__init__(model, training_data)
-        data = self.preprocessor.transform(self.training_data)
+        # LIME selects its own features for each budget ('auto'), so it is
+        # explained once per budget. rank_all instead ranks every feature with
+        # one fit ('none') and slices that ranking to each budget
+        self.budget_dependent = not rank_all
+        self.feature_selection = 'none' if rank_all else 'auto'
+        data = self.training_sample()
         self.explainer = LimeTabularExplainer(
                 training_data=data.astype(float),
-                feature_names=self.feature_names)
+                feature_names=self.feature_names,
+                feature_selection=self.feature_selection)
 
     def explain(self, instance, budget, num_samples=5000):
-        instance = self.preprocessor.transform([instance])[0]
+        if not self.budget_dependent:
+            return self.rank(instance, num_samples)[:budget]
+        return self._explain(instance, budget, num_samples)[:budget]
+
+    def rank(self, instance, num_samples=5000):
+        return self._explain(instance, len(self.feature_names), num_samples)
+
+    def _explain(self, instance, num_features, num_samples):
+        instance = self.transform([instance])[0]
         exp = self.explainer.explain_instance(
                 data_row=instance,
                 predict_fn=self.model.predict_proba,
                 num_samples=num_samples,
-                num_features=budget)
+                num_features=num_features)
 
         feature_pairs = exp.as_map()[1]
         feats = []
         for feat_idx, importance in feature_pairs:
             feats.append( (self.feature_names[feat_idx], importance) )
-        return feats[:budget]
+        return feats
 
 
 class ShapExplainer(Explainer):
+    # Final pipeline steps with exact, polynomial-time Shapley values
+    tree_models = (DecisionTreeClassifier, RandomForestClassifier,
+            xgb.XGBClassifier)
+
     def __init__(self, model, training_data):
         super(ShapExplainer, self).__init__(model, training_data)
-        data = self.preprocessor.transform(training_data)
-        background_data = kmeans(data, 10)
-        self.explainer = KernelExplainer(
-                model=self.model.predict_proba,
-                data=background_data)
+        self.tree = isinstance(self.model, self.tree_models)
+        if self.tree:
+            self.explainer = TreeShap(self.model)
+        else:
+            # KernelSHAP's l1_reg selects exactly `budget` features
+            self.budget_dependent = True
+            data = self.training_sample()
+            background_data = kmeans(data, 10)
+            self.explainer = KernelExplainer(
+                    model=self.model.predict_proba,
+                    data=background_data)
+
+    def rank(self, instance):
+        return self.rank_batch([instance])[0]
+
+    def rank_batch(self, instances):
+        # TreeSHAP only, explains every instance in one call
+        assert self.tree, 'Full rankings need a tree model, use explain()'
+        if isinstance(self.model, xgb.XGBClassifier):
+            # Keep sparse input sparse so XGBoost sees the same missing values
+            # it was trained with
+            data = self.preprocessor.transform(instances)
+        else:
+            data = self.transform(instances)
+
+        values = self.explainer.shap_values(data)
+        # Older shap returns one array per class, newer ones stack classes
+        # last; XGBoost only has the positive class
+        if isinstance(values, list):
+            values = values[1]
+        values = np.asarray(values)
+        if values.ndim == 3:
+            values = values[:, :, 1]
+
+        rankings = []
+        for row in values:
+            rankings.append(sorted(
+                    zip(self.feature_names, row),
+                    key=lambda x : abs(x[1]),
+                    reverse=True
+            ))
+        return rankings
+
+    def explain_batch(self, instances, budget):
+        if self.tree:
+            return [pairs[:budget] for pairs in self.rank_batch(instances)]
+        return [self.explain(instance, budget) for instance in instances]
 
     def explain(self, instance, budget):
-        instance = self.preprocessor.transform([instance])[0]
+        if self.tree:
+            return self.rank(instance)[:budget]
+
+        instance = self.transform([instance])[0]
         values = self.explainer.shap_values(
                 X=instance,
                 nsamples="auto",
@@ -80,35 +182,43 @@ class ShapExplainer(Explainer):
 
 
 class GreedyExplainer(Explainer):
-    def __init__(self, model, training_data):
+    def __init__(self, model, training_data, max_batch_bytes=2**28):
         super(GreedyExplainer, self).__init__(model, training_data)
+        # Memory cap on each batch of perturbed instances scored at once
+        self.max_batch_bytes = max_batch_bytes
 
-    def explain(self, instance, budget):
-        instance = self.preprocessor.transform([instance])
+    def rank(self, instance):
+        instance = self.transform([instance])
         inst = instance.reshape(1, -1)
         base = self.model.predict_proba(inst)[0, 1]
-        values = []
-        for i, val in enumerate(inst[0]):
-            inst[0, i] = 0
-            delta = self.model.predict_proba(inst)[0, 1]
-            values.append(base - delta)
-            inst[0, i] = val
+
+        # Zeroing a feature that is already zero leaves the prediction (and its
+        # importance of 0) unchanged, so only non-zero features are removed.
+        # Each row of a batch removes one feature
+        values = np.zeros(inst.shape[1])
+        nonzero = np.flatnonzero(inst[0])
+        chunk_size = max(1, self.max_batch_bytes // max(1, inst.nbytes))
+        for start in range(0, len(nonzero), chunk_size):
+            idxs = nonzero[start:start + chunk_size]
+            batch = np.repeat(inst, len(idxs), axis=0)
+            batch[np.arange(len(idxs)), idxs] = 0
+            values[idxs] = base - self.model.predict_proba(batch)[:, 1]
 
         pairs = sorted(
                 zip(self.feature_names, values),
                 key=lambda x: abs(x[1]),
                 reverse=True
         )
-        return pairs[:budget]
+        return pairs
 
 
 class RandomExplainer(Explainer):
     def __init__(self, model, training_data):
         super(RandomExplainer, self).__init__(model, training_data)
 
-    def explain(self, instance, budget):
+    def rank(self, instance):
         # Not generating random importances for now, just setting all to 0
-        features = np.random.choice(self.feature_names, budget)
+        features = np.random.permutation(self.feature_names)
         return [(feat, 0.0) for feat in features]
 
 
@@ -116,9 +226,9 @@ class LogisticExplainer(Explainer):
     def __init__(self, model, training_data):
         super(LogisticExplainer, self).__init__(model, training_data)
 
-    def explain(self, instance, budget, p=False):
+    def rank(self, instance, p=False):
         # Pair feature names with importances and sort
-        instance = self.preprocessor.transform([instance])
+        instance = self.transform([instance])
         coef = self.model.coef_[0]
         importances = np.multiply(coef, instance)[0]
 
@@ -128,16 +238,16 @@ class LogisticExplainer(Explainer):
             reverse = True
         )
         if p: print(pairs[:10])
-        return pairs[:budget]
+        return pairs
 
 
 class TreeExplainer(Explainer):
     def __init__(self, model, training_data):
         super(TreeExplainer, self).__init__(model, training_data)
 
-    def explain(self, instance, budget, p=False):
+    def rank(self, instance, p=False):
         # Pair feature names with importances and sort
-        instance = self.preprocessor.transform([instance])[0]
+        instance = self.transform([instance])[0]
         coef = self.model.feature_importances_
         importances = np.multiply(coef, instance)
         pairs = sorted(
@@ -146,12 +256,20 @@ class TreeExplainer(Explainer):
             reverse = True
         )
         if p: print(pairs[:10])
-        return pairs[:budget]
+        return pairs
 
 
 
 # IMAGE EXPLAINERS #############################################################
 
+def top_budget_mask(explanation_2d, budget):
+    # 1.0 on the budget percent of pixels with the highest saliency, else 0.0
+    top_percentile = np.percentile(explanation_2d, 100 - budget)
+    explanation_2d[ explanation_2d < top_percentile ] = 0.0
+    explanation_2d[ explanation_2d >= top_percentile ] = 1.0
+    return explanation_2d
+
+
 class ImageExplainer:
     def __init__(self):
         pass
@@ -159,6 +277,11 @@ class ImageExplainer:
     def explain(self, instance, budget):
         pass
 
+    def explain_batch(self, images, budget):
+        # Masks of every image in a (B, C, H, W) batch. Explainers that can
+        # explain a batch in one pass override this
+        return [self.explain(image, budget) for image in images]
+
 
 class LimeImageExplainer(ImageExplainer):
     def __init__(self, model, label):
@@ -203,32 +326,29 @@ class LimeImageExplainer(ImageExplainer):
 
 class SmoothGradExplainer(ImageExplainer):
 
-    def __init__(self, model, label, cuda=True):
-        self.explainer = gradients.SmoothGrad(
+    def __init__(self, model, label, cuda=True, chunk_size=25):
+        # Noisy copies are drawn on the model's device, chunk_size per pass
+        self.explainer = gradients.BatchedSmoothGrad(
             pretrained_model=model.model,
             cuda=cuda,
             stdev_spread=0.15,
             n_samples=25,
-            magnitude=True
+            magnitude=True,
+            chunk_size=chunk_size
         )
         self.model = model
         self.label = label
 
     def explain(self, instance, budget):
-        # Add necessary preprocessing (batch dim, variable wrapper)
-        instance = instance.unsqueeze(0)
-        instance = Variable(instance.cuda(), requires_grad=True)
-        explanation = self.explainer(instance) #, index=self.label)
+        # Add necessary preprocessing (batch dim)
+        return self.explain_batch(instance.unsqueeze(0), budget)[0]
 
-        # grad explainers return in 3-d
-        explanation_2d = np.sum(explanation, axis=0)
+    def explain_batch(self, images, budget):
+        explanations = self.explainer.grad_batch(images) #, index=self.label)
 
-        # only return above percentile
-        top_percentile = np.percentile(explanation_2d, 100 - budget)
-        explanation_2d[ explanation_2d < top_percentile ] = 0.0
-        explanation_2d[ explanation_2d >= top_percentile ] = 1.0
-
-        return explanation_2d
+        # grad explainers return in 3-d, only return above percentile
+        return [top_budget_mask(np.sum(explanation, axis=0), budget)
+                for explanation in explanations]
 
 
 class VanillaGradExplainer(ImageExplainer):
@@ -242,20 +362,16 @@ class VanillaGradExplainer(ImageExplainer):
         self.label = label
 
     def explain(self, instance, budget):
-        # Add necessary preprocessing (batch dim, variable wrapper)
-        instance = instance.unsqueeze(0)
-        instance = Variable(instance.cuda(), requires_grad=True)
-        explanation = self.explainer(instance) #, index=self.label)
+        # Add necessary preprocessing (batch dim)
+        return self.explain_batch(instance.unsqueeze(0), budget)[0]
 
-        # grad explainers return in 3-d
-        explanation_2d = np.sum(np.abs(explanation), axis=0)
-        top_percentile = np.percentile(explanation_2d, 100 - budget)
+    def explain_batch(self, images, budget):
+        # Each image's gradient of its own predicted class, in one pass
+        explanations = self.explainer.grad_batch(images) #, index=self.label)
 
-        # only return above percentile
-        explanation_2d[ explanation_2d < top_percentile ] = 0.0
-        explanation_2d[ explanation_2d >= top_percentile ] = 1.0
-
-        return explanation_2d
+        # grad explainers return in 3-d, only return above percentile
+        return [top_budget_mask(np.sum(np.abs(explanation), axis=0), budget)
+                for explanation in explanations]
 
 class RandomImageExplainer(ImageExplainer):
     def explain(self, instance, budget):
@@ -304,26 +420,33 @@ class ShapImageExplanier(ImageExplainer):
 class GradCamExplainer(ImageExplainer):
     def __init__(self, model_wrapper, target_layer, label):
         self.model = model_wrapper.model
-        self.explainer = GradCAM(model=self.model)
+        assert target_layer in dict(self.model.named_modules()), \
+                'Unknown target layer: {}'.format(target_layer)
+        # Hooks only the target layer, the one wrapper serves every image
+        self.explainer = GradCAM(model=self.model,
+                candidate_layers=[target_layer])
         self.target_layer = target_layer
         self.label = label
 
     def explain(self, instance, budget):
-        instance = instance.unsqueeze(0).cuda()
+        return self.explain_batch(instance.unsqueeze(0), budget)[0]
 
-        probs, ids = self.explainer.forward(instance)
+    def explain_batch(self, images, budget):
+        images = images.to(self.explainer.device)
+
+        probs, ids = self.explainer.forward(images)
         # print(probs, ids)
-        target_ids = torch.LongTensor([[self.label]]).cuda()
-        self.explainer.backward(ids=target_ids)
+        # One-hot of self.label for every sample
+        target_ids = torch.full((len(images), 1), self.label, dtype=torch.long,
+                device=self.explainer.device)
+        # One backward pass per forward, no graph is kept for later images
+        self.explainer.backward(ids=target_ids, retain_graph=False)
         regions = self.explainer.generate(target_layer=self.target_layer)
-        explanation_3d = regions[0].double().detach().cpu().numpy()
-
-        explanation_2d = np.sum(np.abs(explanation_3d), axis=0)
-        top_percentile = np.percentile(explanation_2d, 100 - budget)
+        explanations_3d = regions.double().detach().cpu().numpy()
+        self.explainer.release()
 
         # only return above percentile
-        explanation_2d[ explanation_2d < top_percentile ] = 0.0
-        explanation_2d[ explanation_2d >= top_percentile ] = 1.0
-
-        return explanation_2d.astype(np.float32)
+        return [top_budget_mask(np.sum(np.abs(explanation_3d), axis=0), budget)
+                    .astype(np.float32)
+                for explanation_3d in explanations_3d]
 
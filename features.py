@@ -0,0 +1,317 @@
+import os
+import json
+import numbers
+import hashlib
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import (
+        CountVectorizer,
+        TfidfVectorizer,
+        TfidfTransformer
+)
+
+CACHE_DIR = 'feature_cache'     # Default directory for cached featurizations
+
+# Vectorizer parameters that decide how documents are tokenized
+ANALYZER_PARAMS = [
+    'input',
+    'encoding',
+    'decode_error',
+    'strip_accents',
+    'lowercase',
+    'preprocessor',
+    'tokenizer',
+    'stop_words',
+    'token_pattern',
+    'ngram_range',
+    'analyzer',
+]
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    # Hash of the file contents, so renamed or touched datasets still hit
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def docs_fingerprint(docs):
+    h = hashlib.sha1()
+    for doc in docs:
+        h.update(str(doc).encode('utf-8', 'surrogatepass'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def vectorizer_fingerprint(vectorizer):
+    # Returns None for vectorizers with custom callables (e.g. a tokenizer
+    # lambda), their behaviour can not be fingerprinted so they are not cached
+    params = vectorizer.get_params()
+    for value in params.values():
+        if callable(value) and not isinstance(value, type):
+            return None
+    params['class'] = type(vectorizer).__name__
+    return json.dumps(params, sort_keys=True, default=repr)
+
+
+def vocabulary_fingerprint(vectorizer):
+    # Hash of a fitted vectorizer's vocabulary (and idf weights), the state a
+    # transformed matrix depends on
+    h = hashlib.sha1()
+    vocab = sorted((term, int(i)) for term, i in vectorizer.vocabulary_.items())
+    h.update(json.dumps(vocab).encode('utf-8'))
+    if getattr(vectorizer, 'idf_', None) is not None:
+        h.update(np.ascontiguousarray(vectorizer.idf_, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    # On-disk cache of fitted vectorizer vocabularies and the CSR document-term
+    # matrices they produce. Entries are keyed by the dataset file, the split
+    # seed and the vectorizer parameters; matrices are stored as raw .npy
+    # arrays and memory-mapped on load.
+    #
+    # Layout: <cache_dir>/<key>/vocab.json      fitted vocabulary
+    #                          /idf.npy         (tf-idf only)
+    #                          /fit.json        digest of the fitted documents
+    #                          /<vocab>_<docs>.*.npy
+    #                                           CSR arrays, one set per corpus
+    #                                           and fitted vocabulary
+
+    def __init__(self, cache_dir, data_path, split_seed):
+        self.cache_dir = cache_dir
+        self.dataset = file_fingerprint(data_path)
+        self.split_seed = split_seed
+
+    def fit_transform(self, vectorizer, docs):
+        entry = self._entry(vectorizer)
+        if entry is None:
+            return vectorizer.fit_transform(docs)
+
+        digest = docs_fingerprint(docs)
+        if self._fitted_on(entry) == digest:
+            self._load_vocabulary(vectorizer, entry)
+            return self._cached_transform(vectorizer, docs, entry, digest)
+
+        # Miss (or the split changed, e.g. on a retry), refit and overwrite
+        vec = vectorizer.fit_transform(docs)
+        if not os.path.exists(entry):
+            os.makedirs(entry)
+        self._save_vocabulary(vectorizer, entry)
+        _write_json(os.path.join(entry, 'fit.json'), {'docs': digest})
+        prefix = self._prefix(vectorizer, entry, digest)
+        self._save_matrix(vec, prefix)
+        return self._load_matrix(prefix)
+
+    def transform(self, vectorizer, docs):
+        # vectorizer must have been fitted through fit_transform
+        entry = self._entry(vectorizer)
+        if entry is None:
+            return vectorizer.transform(docs)
+        return self._cached_transform(vectorizer, docs, entry,
+                docs_fingerprint(docs))
+
+    def _entry(self, vectorizer):
+        params = vectorizer_fingerprint(vectorizer)
+        if params is None:
+            return None
+        h = hashlib.sha1()
+        for part in [self.dataset, str(self.split_seed), params]:
+            h.update(part.encode('utf-8'))
+        return os.path.join(self.cache_dir, h.hexdigest())
+
+    def _fitted_on(self, entry):
+        fit_path = os.path.join(entry, 'fit.json')
+        if not os.path.exists(fit_path):
+            return None
+        with open(fit_path, 'r') as f:
+            return json.load(f)['docs']
+
+    def _prefix(self, vectorizer, entry, digest):
+        # Matrices are only valid for the vocabulary they were built with, the
+        # one in memory (another process may have refit the entry on disk)
+        return os.path.join(entry, '{}_{}'.format(
+                vocabulary_fingerprint(vectorizer), digest))
+
+    def _cached_transform(self, vectorizer, docs, entry, digest):
+        prefix = self._prefix(vectorizer, entry, digest)
+        vec = self._load_matrix(prefix)
+        if vec is None:
+            self._save_matrix(vectorizer.transform(docs), prefix)
+            vec = self._load_matrix(prefix)
+        return vec
+
+    def _save_vocabulary(self, vectorizer, entry):
+        vocab = {term: int(i) for term, i in vectorizer.vocabulary_.items()}
+        _write_json(os.path.join(entry, 'vocab.json'), vocab)
+        if isinstance(vectorizer, TfidfVectorizer):
+            _write_npy(os.path.join(entry, 'idf.npy'), vectorizer.idf_)
+
+    def _load_vocabulary(self, vectorizer, entry):
+        with open(os.path.join(entry, 'vocab.json'), 'r') as f:
+            vectorizer.vocabulary_ = json.load(f)
+        vectorizer.stop_words_ = set()
+        if isinstance(vectorizer, TfidfVectorizer):
+            vectorizer.idf_ = np.load(os.path.join(entry, 'idf.npy'))
+
+    def _save_matrix(self, vec, prefix):
+        vec = sp.csr_matrix(vec)
+        _write_npy(prefix + '.data.npy', vec.data)
+        _write_npy(prefix + '.indices.npy', vec.indices)
+        _write_npy(prefix + '.indptr.npy', vec.indptr)
+        # Shape is written last and marks the matrix as complete
+        _write_npy(prefix + '.shape.npy', np.array(vec.shape))
+
+    def _load_matrix(self, prefix):
+        if not os.path.exists(prefix + '.shape.npy'):
+            return None
+        shape = tuple(np.load(prefix + '.shape.npy'))
+        data = _load_npy(prefix + '.data.npy')
+        indices = _load_npy(prefix + '.indices.npy')
+        indptr = _load_npy(prefix + '.indptr.npy')
+        return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+class SharedCounts:
+    # Tokenizes a training corpus once, into raw counts over every term, and
+    # derives the fitted vocabularies and matrices of other vectorizers from
+    # them by selecting columns (e.g. the bias vocabulary of ComplexBias and
+    # the vocabulary of the models). Has the same fit_transform / transform
+    # interface as FeatureCache and can be passed wherever a cache is taken.
+    # Vectorizers that tokenize differently, or other corpora given to
+    # fit_transform, fall through to the cache (if any) or the vectorizer.
+
+    def __init__(self, docs, cache=None):
+        self.cache = cache
+        self.digest = docs_fingerprint(docs)
+        self.vectorizer = CountVectorizer()
+        if cache is None:
+            self.X = sp.csr_matrix(self.vectorizer.fit_transform(docs))
+        else:
+            self.X = cache.fit_transform(self.vectorizer, docs)
+        self.terms = self.vectorizer.get_feature_names()
+
+        # Document frequency and term frequency of every term
+        self.df = np.bincount(self.X.indices, minlength=self.X.shape[1])
+        self.tf = np.asarray(self.X.sum(axis=0)).ravel()
+        self._last = None   # (digest, counts) of the last transformed corpus
+
+    def fit_transform(self, vectorizer, docs):
+        if not self._compatible(vectorizer) or docs_fingerprint(docs) != self.digest:
+            return self._fallback(vectorizer, docs, fit=True)
+
+        columns = self._select(vectorizer)
+        vectorizer.vocabulary_ = {self.terms[c]: i for i, c in enumerate(columns)}
+        vectorizer.stop_words_ = set()
+        X = self._counts(vectorizer, self.X, columns)
+        if isinstance(vectorizer, TfidfVectorizer):
+            # Same idf weights TfidfVectorizer.fit would compute on X
+            idf = TfidfTransformer(
+                    norm=vectorizer.norm,
+                    use_idf=vectorizer.use_idf,
+                    smooth_idf=vectorizer.smooth_idf,
+                    sublinear_tf=vectorizer.sublinear_tf).fit(X)
+            if vectorizer.use_idf:
+                vectorizer.idf_ = idf.idf_
+            X = idf.transform(X, copy=False)
+        return X
+
+    def transform(self, vectorizer, docs):
+        # vectorizer must have been fitted, its vocabulary is looked up in
+        # the shared one
+        columns = None
+        if self._compatible(vectorizer):
+            vocab = self.vectorizer.vocabulary_
+            terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+            if all(term in vocab for term in terms):
+                columns = np.array([vocab[term] for term in terms], dtype=np.int64)
+        if columns is None:
+            return self._fallback(vectorizer, docs, fit=False)
+
+        X = self._counts(vectorizer, self._base_transform(docs), columns)
+        if isinstance(vectorizer, TfidfVectorizer):
+            X = vectorizer._tfidf.transform(X, copy=False)
+        return X
+
+    def _compatible(self, vectorizer):
+        if not isinstance(vectorizer, CountVectorizer):
+            return False
+        if vectorizer.vocabulary is not None:
+            return False
+        params = vectorizer.get_params()
+        base = self.vectorizer.get_params()
+        return all(params[key] == base[key] for key in ANALYZER_PARAMS)
+
+    def _select(self, vectorizer):
+        # Columns CountVectorizer.fit would keep, see its _limit_features
+        n_docs = self.X.shape[0]
+        max_df, min_df = vectorizer.max_df, vectorizer.min_df
+        high = max_df if isinstance(max_df, numbers.Integral) else max_df * n_docs
+        low = min_df if isinstance(min_df, numbers.Integral) else min_df * n_docs
+        mask = (self.df <= high) & (self.df >= low)
+
+        limit = vectorizer.max_features
+        if limit is not None and mask.sum() > limit:
+            # Binary vectorizers count every term once per document
+            tfs = self.df if vectorizer.binary else self.tf
+            keep = (-tfs[mask]).argsort()[:limit]
+            new_mask = np.zeros_like(mask)
+            new_mask[np.where(mask)[0][keep]] = True
+            mask = new_mask
+        return np.where(mask)[0]
+
+    def _counts(self, vectorizer, counts, columns):
+        X = counts[:, columns]
+        if vectorizer.binary:
+            X.data = np.ones_like(X.data)
+        if not isinstance(vectorizer, TfidfVectorizer):
+            X = X.astype(vectorizer.dtype, copy=False)
+        return X
+
+    def _base_transform(self, docs):
+        digest = docs_fingerprint(docs)
+        if digest == self.digest:
+            return self.X
+        if self._last is None or self._last[0] != digest:
+            if self.cache is None:
+                counts = self.vectorizer.transform(docs)
+            else:
+                counts = self.cache.transform(self.vectorizer, docs)
+            self._last = (digest, sp.csr_matrix(counts))
+        return self._last[1]
+
+    def _fallback(self, vectorizer, docs, fit):
+        if self.cache is not None:
+            if fit:
+                return self.cache.fit_transform(vectorizer, docs)
+            return self.cache.transform(vectorizer, docs)
+        if fit:
+            return vectorizer.fit_transform(docs)
+        return vectorizer.transform(docs)
+
+
+# Write to a temporary file and rename, so concurrent workers sharing a cache
+# never see partial files
+def _write_npy(path, array):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(array))
+    os.replace(tmp_path, path)
+
+
+def _load_npy(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # Empty arrays can not be memory-mapped on some numpy versions
+        return np.load(path)
+
+
+def _write_json(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
@@ -32,13 +32,14 @@ class _BaseWrapper(object):
         self.probs = F.softmax(self.logits, dim=1)
         return self.probs.sort(dim=1, descending=True)  # ordered results
 
-    def backward(self, ids):
+    def backward(self, ids, retain_graph=True):
         """
-        Class-specific backpropagation
+        Class-specific backpropagation. Pass retain_graph=False when no other
+        backward pass follows on the same forward, to free the graph
         """
         one_hot = self._encode_one_hot(ids)
         self.model.zero_grad()
-        self.logits.backward(gradient=one_hot, retain_graph=True)
+        self.logits.backward(gradient=one_hot, retain_graph=retain_graph)
 
     def generate(self):
         raise NotImplementedError
@@ -157,6 +158,15 @@ class GradCAM(_BaseWrapper):
 
         return gcam
 
+    def release(self):
+        """
+        Drop the pooled feature maps and gradients and the last outputs
+        """
+        self.fmap_pool.clear()
+        self.grad_pool.clear()
+        self.logits = None
+        self.probs = None
+
 
 def occlusion_sensitivity(
     model, images, ids, mean=None, patch=35, stride=1, n_batches=128
@@ -38,6 +38,29 @@ class VanillaGrad(object):
 
         return grad
 
+    def grad_batch(self, x, index=None):
+        # Gradients of a (B, C, H, W) batch in one forward / backward pass.
+        # index is one class for all samples, one per sample, or None for
+        # each sample's predicted class
+        device = next(self.pretrained_model.parameters()).device
+        x = x.detach().to(device).requires_grad_(True)
+        output = self.pretrained_model(x)
+        one_hot = one_hot_targets(output, index)
+        grad, = torch.autograd.grad(output, x, grad_outputs=one_hot)
+        return grad.cpu().numpy()
+
+
+def one_hot_targets(output, index=None):
+    # Per-sample one-hot selection of the target logits of a (B, classes)
+    # output, samples are independent so one backward pass serves them all
+    if index is None:
+        index = torch.argmax(output, dim=1)
+    index = torch.as_tensor(index, device=output.device).long()
+    index = index.expand(output.size(0)).reshape(-1, 1)
+    one_hot = torch.zeros_like(output)
+    one_hot.scatter_(1, index, 1.0)
+    return one_hot
+
 
 class SmoothGrad(VanillaGrad):
 
@@ -97,6 +120,61 @@ class SmoothGrad(VanillaGrad):
         return avg_gradients
 
 
+class BatchedSmoothGrad(SmoothGrad):
+    # SmoothGrad with the noisy copies drawn on the model's device and run
+    # chunk_size at a time, one forward and one backward pass per chunk
+
+    def __init__(self, pretrained_model, cuda=False, stdev_spread=0.15,
+                 n_samples=25, magnitude=True, chunk_size=25):
+        super(BatchedSmoothGrad, self).__init__(
+            pretrained_model, cuda, stdev_spread, n_samples, magnitude)
+        self.chunk_size = chunk_size
+
+    def __call__(self, x, index=None):
+        return self.grad_batch(x, index)[0]
+
+    def grad_batch(self, x, index=None):
+        # SmoothGrad of every image in a (B, C, H, W) batch. Copy j of all B
+        # images is generated together, chunk_size // B copies (at least one)
+        # per pass. Each image targets index or, if None, the class predicted
+        # for its first noisy copy
+        device = next(self.pretrained_model.parameters()).device
+        x = x.detach().to(device)
+        B = x.size(0)
+        flat = x.view(B, -1)
+        stdev = self.stdev_spread * (flat.max(dim=1)[0] - flat.min(dim=1)[0])
+        stdev = stdev.view(B, 1, 1, 1)
+        total_gradients = torch.zeros_like(x)
+        targets = None
+        if index is not None:
+            targets = torch.as_tensor(index, device=device).long().expand(B)
+
+        copies = max(1, self.chunk_size // B)
+        done = 0
+        while done < self.n_samples:
+            n = min(copies, self.n_samples - done)
+            noise = torch.randn((n,) + x.shape, device=device) * stdev
+            x_plus_noise = (x + noise).view((n * B,) + x.shape[1:])
+            x_plus_noise.requires_grad_(True)
+            output = self.pretrained_model(x_plus_noise)
+
+            if targets is None:
+                targets = torch.argmax(output[:B], dim=1)
+            one_hot = one_hot_targets(output, targets.repeat(n))
+            grad, = torch.autograd.grad(output, x_plus_noise, grad_outputs=one_hot)
+            grad = grad.view((n,) + x.shape)
+
+            if self.magnitutde:
+                total_gradients += (grad * grad).sum(dim=0)
+            else:
+                total_gradients += grad.sum(dim=0)
+            done += n
+
+        avg_gradients = total_gradients / self.n_samples
+
+        return avg_gradients.cpu().numpy()
+
+
 class GuidedBackpropReLU(torch.autograd.Function):
 
     def __init__(self, inplace=False):
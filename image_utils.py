@@ -1,7 +1,13 @@
 import os
 import time
 import copy
+import random
+import inspect
+import multiprocessing
+import shutil
+import hashlib
 
+import cv2
 import tqdm
 import torch
 import numpy as np
@@ -11,7 +17,7 @@ from PIL import Image
 from torch import nn, optim
 import torch.nn.functional as F
 import torchvision.transforms.functional as FT
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
 from torchvision import models, datasets, transforms
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, f1_score
@@ -19,6 +25,159 @@ from sklearn.metrics import accuracy_score, f1_score
 import utils
 
 NUM_ATTRS = 312
+EVAL_BATCH_SIZE = 64    # Images per batch in evaluate_models
+EVAL_WORKERS = 4        # DataLoader workers decoding images in evaluate_models
+LOAD_WORKERS = 4        # DataLoader workers decoding and augmenting while training
+PREFETCH_FACTOR = 2     # Batches loaded ahead by each of those workers
+STORE_SIZE = 288        # Shorter side of pre-decoded images, above INPUT_SIZE
+USE_IMAGE_STORE = True  # Read images from an ImageStore instead of the JPEGs
+
+
+def seed_worker(worker_id):
+    # torch seeds each worker with base_seed + worker_id, the base seed is drawn
+    # from the (seeded) main process. Albumentations draws from random and
+    # numpy, which forked workers would otherwise share
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def make_dataloader(dataset, batch_size, shuffle=False, num_workers=LOAD_WORKERS,
+        persistent_workers=True, prefetch_factor=PREFETCH_FACTOR, ordered=False):
+    # A dataset with its own sampler (e.g. the oversampled train split) is
+    # drawn from that instead of being shuffled, unless ordered is set
+    sampler = None if ordered else getattr(dataset, 'sampler', None)
+    shuffle = shuffle and not ordered
+
+    # Daemonic pool workers (one per seed) can not start loader workers
+    if multiprocessing.current_process().daemon:
+        num_workers = 0
+
+    kwargs = {
+        'batch_size': batch_size,
+        'sampler': sampler,
+        'shuffle': shuffle and sampler is None,
+        'num_workers': num_workers,
+        'pin_memory': torch.cuda.is_available(),
+        'worker_init_fn': seed_worker,
+    }
+    # Only valid with workers, and only in torch >= 1.7
+    params = inspect.signature(DataLoader).parameters
+    if num_workers > 0 and 'persistent_workers' in params:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+    return DataLoader(dataset, **kwargs)
+
+
+def read_image(path):
+    # Decoded RGB image as an (h, w, 3) uint8 array
+    with open(path, 'rb') as f:
+        image_file = Image.open(f)
+        image_rgb  = image_file.convert('RGB')
+        image_rgb  = np.array(image_rgb)
+    return image_rgb
+
+
+def stored_shape(height, width, size=STORE_SIZE):
+    # (height, width) with the shorter side scaled to size, aspect ratio kept
+    scale = size / min(height, width)
+    return max(size, int(round(height * scale))), max(size, int(round(width * scale)))
+
+
+class ImageStore:
+    # Images decoded once, resized so their shorter side is size (aspect ratio
+    # kept, so crops still see real pixels) and packed back to back in a single
+    # memory-mapped uint8 array. One store is built per selection of images and
+    # shared by every split, epoch and process using it:
+    #
+    #   <data_dir>/image_store/short<size>_<key>/images.npy  flat pixels
+    #                                           /index.npz   img_ids (sorted),
+    #                                                        offsets, stored and
+    #                                                        original sizes
+
+    def __init__(self, data_dir, img_ids, img_paths, size=STORE_SIZE):
+        img_ids = np.asarray(img_ids, dtype=np.int64)
+        order = np.argsort(img_ids)
+        img_ids = img_ids[order]
+        img_paths = np.asarray(img_paths, dtype=object)[order]
+
+        key = hashlib.sha1(img_ids.tobytes()).hexdigest()[:12]
+        self.size = size
+        self.directory = os.path.join(data_dir, 'image_store',
+                'short{}_{}'.format(size, key))
+        if not os.path.exists(os.path.join(self.directory, 'index.npz')):
+            self._build(data_dir, img_ids, img_paths)
+
+        index = np.load(os.path.join(self.directory, 'index.npz'))
+        self.img_ids = index['img_ids']
+        self.offsets = index['offsets']
+        self.heights = index['heights']
+        self.widths = index['widths']
+        self.orig_heights = index['orig_heights']
+        self.orig_widths = index['orig_widths']
+        self.pixels = np.load(os.path.join(self.directory, 'images.npy'),
+                mmap_mode='r')
+
+    def rows(self, img_ids):
+        img_ids = np.asarray(img_ids)
+        rows = np.searchsorted(self.img_ids, img_ids)
+        assert np.all(self.img_ids[rows] == img_ids), 'Image missing from store'
+        return rows
+
+    def image(self, row):
+        # Read-only (h, w, 3) view into the memory map, nothing is copied
+        start = self.offsets[row]
+        height, width = self.heights[row], self.widths[row]
+        return self.pixels[start:start + height * width * 3] \
+                .reshape(height, width, 3)
+
+    def scale_keypoints(self, rows, keypoints):
+        # (n, 2) xy keypoints of the original images to the stored sizes
+        keypoints = np.asarray(keypoints, dtype=np.float64)
+        scale = np.stack([self.widths[rows] / self.orig_widths[rows],
+                self.heights[rows] / self.orig_heights[rows]], axis=1)
+        return keypoints * scale
+
+    def _build(self, data_dir, img_ids, img_paths):
+        print('Building image store: {}'.format(self.directory))
+        tmp_dir = '{}.{}.tmp'.format(self.directory, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        paths = [os.path.join(data_dir, 'images', path) for path in img_paths]
+
+        # Sizes come from the image headers, the array is allocated up front
+        n = len(img_ids)
+        orig_heights = np.zeros(n, dtype=np.int64)
+        orig_widths = np.zeros(n, dtype=np.int64)
+        heights = np.zeros(n, dtype=np.int64)
+        widths = np.zeros(n, dtype=np.int64)
+        for i, path in enumerate(paths):
+            with Image.open(path) as image_file:
+                orig_widths[i], orig_heights[i] = image_file.size
+            heights[i], widths[i] = stored_shape(orig_heights[i], orig_widths[i],
+                    self.size)
+        sizes = heights * widths * 3
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+
+        pixels = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'),
+                mode='w+', dtype=np.uint8, shape=(int(np.sum(sizes)),))
+        for i, path in enumerate(tqdm.tqdm(paths, total=n)):
+            image_rgb = read_image(path)
+            assert image_rgb.shape[:2] == (orig_heights[i], orig_widths[i])
+            resized = cv2.resize(image_rgb, (int(widths[i]), int(heights[i])),
+                    interpolation=cv2.INTER_LINEAR)
+            pixels[offsets[i]:offsets[i] + sizes[i]] = resized.ravel()
+        pixels.flush()
+        del pixels
+        np.savez(os.path.join(tmp_dir, 'index.npz'), img_ids=img_ids,
+                offsets=offsets, heights=heights, widths=widths,
+                orig_heights=orig_heights, orig_widths=orig_widths)
+
+        # Rename into place, another process may have finished first
+        try:
+            os.rename(tmp_dir, self.directory)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
 
 class BirdDataset(Dataset):
     def __init__(self, mode, transform=None, bias=None, binary=True,
@@ -32,6 +191,12 @@ class BirdDataset(Dataset):
         self.transform = transform
         self.binary = binary
         self.bias = bias
+        self.store = None
+
+        # The train split oversamples R through sample weights (rather than
+        # duplicate rows), self.sampler draws epochs of len(self) with them
+        self.weights = None
+        self.sampler = None
 
         # Build self.data DataFrame ############################################
 
@@ -74,9 +239,7 @@ class BirdDataset(Dataset):
         if binary:
             assert len(binary_classes) == 2
             bird_labels = { binary_classes[0] : 0, binary_classes[1] : 1 }
-            get_name = lambda row: row['img_path'].split('_')[-3]
-
-            data['bird_name'] = data.apply(get_name, axis=1)
+            data['bird_name'] = data['img_path'].str.split('_').str[-3]
             data['label'] = data['bird_name'].map(bird_labels)
             data.dropna(inplace=True)
             data.reset_index(drop=True, inplace=True)
@@ -84,6 +247,10 @@ class BirdDataset(Dataset):
             # We will change this later using the bias object
             data['label'] = 0
 
+        # Every split of this selection of images reads the same store
+        if USE_IMAGE_STORE:
+            self.store = ImageStore(self.data_dir, data['img_id'], data['img_path'])
+
         # Train / Val / Test Split #############################################
         train_test_data = pd.read_csv(self.data_dir + 'train_test_split_custom.txt',
             sep=' ', header=None, names=['img_id', 'is_train'])
@@ -106,19 +273,14 @@ class BirdDataset(Dataset):
             # No bias label to create, just clean up
             data.reset_index(drop=True, inplace=True)
             self.data = data
+            self._freeze()
             return
 
-        def apply_bias(row):
-            attrs = row.loc[ list(range(1, NUM_ATTRS + 1)) ].to_numpy(dtype='int')
-            label = row.loc['label']
-            bias_label, biased, flipped = bias.bias(attrs, label)
-            index = ['bias_label', 'biased', 'flipped']
-            return pd.Series([bias_label, biased, flipped], index=index)
-
-        bias_columns = data.apply(apply_bias, axis=1, result_type='expand')
-        data['bias_label'] = bias_columns['bias_label']
-        data['biased'] = bias_columns['biased']
-        data['flipped'] = bias_columns['flipped']
+        attrs = data[ list(range(1, NUM_ATTRS + 1)) ].to_numpy(dtype='int')
+        bias_labels, biased, flipped = bias.stain(attrs, data['label'].to_numpy())
+        data['bias_label'] = bias_labels
+        data['biased'] = biased
+        data['flipped'] = flipped
 
         # Filter out biased examples with no part location
         part_data = pd.read_csv(
@@ -138,32 +300,57 @@ class BirdDataset(Dataset):
         data = data.merge(part_data, on='img_id')
         error = data['biased'] & (data['visible'] == 0)
         data = data[ ~error ]
-        data = utils.oversample(data, r_factor=2.0) if mode == 'train' else data
         data.reset_index(drop=True, inplace=True)
         self.data = data
+        self._freeze()
+
+        if mode == 'train':
+            self.weights = utils.oversample_weights(data['biased'], r_factor=2.0)
+            self.sampler = WeightedRandomSampler(
+                    torch.as_tensor(self.weights, dtype=torch.double),
+                    num_samples=len(self.weights),
+                    replacement=True)
+
+    def _freeze(self):
+        # Copy the columns __getitem__ reads into plain arrays, so item lookup
+        # does not go through pandas
+        data = self.data
+        self.img_ids = data['img_id'].to_numpy()
+        self.paths = data['img_path'].to_numpy(dtype=object)
+        self.labels = data['label'].to_numpy().astype(int)
+        self.attrs = np.ascontiguousarray(
+                data[ list(range(1, NUM_ATTRS + 1)) ].to_numpy(dtype=np.int8))
+
+        if self.store is not None:
+            self.store_rows = self.store.rows(self.img_ids)
+
+        if self.bias is not None:
+            self.bias_labels = data['bias_label'].to_numpy().astype(int)
+            self.biased = data['biased'].to_numpy(dtype=bool)
+            self.flipped = data['flipped'].to_numpy(dtype=bool)
+            self.part_xy = data[ ['part_x', 'part_y'] ].to_numpy()
+            if self.store is not None:
+                # Keypoints of the stored, resized images
+                self.part_xy = self.store.scale_keypoints(self.store_rows,
+                        self.part_xy)
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        row = self.data.loc[idx]
-        img_id = row['img_id']
-        attrs = row.loc[ list(range(1, NUM_ATTRS + 1)) ].to_numpy(dtype='int')
-        label = row['label'].astype(int)
-        path  = row['img_path']
-
-        with open(self.data_dir + 'images/' + path, 'rb') as f:
-            image_file = Image.open(f)
-            image_rgb  = image_file.convert('RGB')
-            image_rgb  = np.array(image_rgb)
+        img_id = self.img_ids[idx]
+        attrs = self.attrs[idx]
+        label = self.labels[idx]
+        path  = self.paths[idx]
+
+        if self.store is not None:
+            # Read-only view into the store, transforms return new arrays
+            image_rgb = self.store.image(self.store_rows[idx])
+        else:
+            image_rgb = read_image(self.data_dir + 'images/' + path)
 
         if self.bias is not None:
-            visible = row['visible']
-            keypoints = [ (row['part_x'], row['part_y']) ]
-            # print(img_id)
-            # print(keypoints[0])
-            # print(image_rgb.shape)
-            # print('-' * 10)
+            keypoints = [ tuple(self.part_xy[idx]) ]
             transformed = self.transform(image=image_rgb, keypoints=keypoints)
             keypoints = np.array(transformed['keypoints'], dtype=np.int32)
 
@@ -180,9 +367,9 @@ class BirdDataset(Dataset):
                 'path' : path,
 
                 # bias specific
-                'biased'    : row['biased'],
-                'flipped'   : row['flipped'],
-                'bias_label': row['bias_label'].astype(int),
+                'biased'    : self.biased[idx],
+                'flipped'   : self.flipped[idx],
+                'bias_label': self.bias_labels[idx],
                 'part_x'    : int(round(keypoints[0][0])),
                 'part_y'    : int(round(keypoints[0][1])),
                 # 'clicks'    : click_keypoints,
@@ -206,7 +393,9 @@ class BirdDataset(Dataset):
 
 
 
-def evaluate_models(orig_model, bias_model, test_data, runlog):
+# Both models predict on the same decoded batches
+def evaluate_models(orig_model, bias_model, test_data, runlog,
+        batch_size=EVAL_BATCH_SIZE, num_workers=EVAL_WORKERS):
 
     if orig_model is not None:
         orig_model.model.eval()
@@ -218,29 +407,25 @@ def evaluate_models(orig_model, bias_model, test_data, runlog):
 
     bias_model.model.eval()
 
-    for name, model in models.items():
-        y_true = []
-        y_pred = []
-        biased = []
-        length = len(test_data)
-        for i in tqdm.tqdm(range(length), total=length):
-            example = test_data[i]
-            true = example['label' if name == 'orig' else 'bias_label']
-            with torch.no_grad():
-                pred = model.predict(example['image']).item()
-
-            y_true.append(true)
-            y_pred.append(pred)
-            biased.append(example['biased'])
-
-        y_true = np.array(y_true)
-        y_pred = np.array(y_pred)
-        biased = np.array(biased)
-
-        acc    = float(accuracy_score(y_true, y_pred))
-        f1     = float(f1_score(y_true, y_pred))
-        acc_r  = float(accuracy_score(y_true[biased], y_pred[biased]))
-        acc_nr = float(accuracy_score(y_true[~biased], y_pred[~biased]))
+    loader = make_dataloader(test_data, batch_size, num_workers=num_workers,
+            persistent_workers=False)
+
+    # torch.inference_mode was added in torch 1.9
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+    metrics = utils.RegionMetrics(list(models))
+    with inference_mode():
+        for batch in tqdm.tqdm(loader, total=len(loader)):
+            y_true = {'orig': batch['label'], 'bias': batch['bias_label']}
+            y_pred = {name: model.predict(batch['image']).cpu()
+                    for name, model in models.items()}
+            metrics.update(y_true, y_pred, batch['biased'])
+
+    for name in models:
+        acc    = metrics.accuracy(name)
+        f1     = metrics.f1(name)
+        acc_r  = metrics.accuracy(name, 'R')
+        acc_nr = metrics.accuracy(name, 'NR')
 
         runlog[name + '_test_acc'] = acc
         runlog[name + '_test_f1']  = f1
@@ -255,8 +440,4 @@ def evaluate_models(orig_model, bias_model, test_data, runlog):
 
     if orig_model is not None:
         # legacy (for plotting)
-        runlog['results'] = [
-            [runlog['orig_R_acc'], runlog['orig_NR_acc']],
-            [runlog['bias_R_acc'], runlog['bias_NR_acc']],
-        ]
-
+        runlog['results'] = metrics.results()
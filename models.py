@@ -19,10 +19,15 @@ from sklearn.metrics import accuracy_score, f1_score, precision_score
 from skorch import NeuralNetClassifier
 from skorch import callbacks
 import torchvision
+from torch.utils.data import Dataset, DataLoader
+
+from image_utils import make_dataloader, LOAD_WORKERS
 
 
 MIN_OCCURANCE = 0.01            # Min occurance for words to be vectorized
 MAX_OCCURANCE = 1.00            # Max occurance for words to be vectorized
+SPARSE = False                  # Pass CSR features to models that accept it
+SPARSE_MODELS = ['logistic', 'dt', 'rf', 'xgb']    # Pipelines with a sparse mode
 
 # MLP Features learned through CV
 
@@ -33,6 +38,8 @@ MLP_LR = 0.1
 MLP_PATIENCE = 4
 MLP_BATCH = 8
 
+HEAD_VIEWS = 5                  # Augmented views cached per training image
+
 # # IMDb, Amazon
 # MLP_MAX_VOCAB = 150
 # MLP_N_HIDDEN = 50
@@ -45,54 +52,55 @@ def ds_f1(net, ds, y=None):
     y_pred = net.predict(ds)
     return sklearn.metrics.f1_score(y_true, y_pred)
 
+def to_dense(sparse=False):
+    # 'dense' pipeline step, skipped (None) when the model takes sparse input
+    if sparse:
+        return None
+    return FunctionTransformer(
+            lambda x: x.toarray(),
+            validate=False,
+            accept_sparse=True)
+
 # Model names to Pipeline (lambda for lazy init)
 pipelines = {
-    'logistic': lambda: Pipeline([
+    'logistic': lambda sparse=SPARSE: Pipeline([
         ('counts', CountVectorizer(
             min_df=MIN_OCCURANCE,
             max_df=MAX_OCCURANCE,
             binary=True)),
-        ('dense', FunctionTransformer(
-            lambda x: x.toarray(),
-            validate=False,
-            accept_sparse=True)),
+        ('dense', to_dense(sparse)),
         ('model', LogisticRegression(solver='lbfgs')),
     ]),
 
-    'dt': lambda: Pipeline([
+    'dt': lambda sparse=SPARSE: Pipeline([
         ('counts', CountVectorizer(
             min_df=MIN_OCCURANCE,
             max_df=MAX_OCCURANCE,
             binary=True)),
-        ('dense', FunctionTransformer(
-            lambda x: x.toarray(),
-            validate=False,
-            accept_sparse=True)),
+        ('dense', to_dense(sparse)),
         ('model', DecisionTreeClassifier()),
     ]),
 
-    'rf': lambda: Pipeline([
+    'rf': lambda sparse=SPARSE: Pipeline([
         ('counts', CountVectorizer(
             min_df=MIN_OCCURANCE,
             max_df=MAX_OCCURANCE,
             binary=True)),
-        ('dense', FunctionTransformer(
-            lambda x: x.toarray(),
-            validate=False,
-            accept_sparse=True)),
+        ('dense', to_dense(sparse)),
         ('model', RandomForestClassifier(n_estimators=100)),
     ]),
 
-    'xgb': lambda: Pipeline([
+    'xgb': lambda sparse=SPARSE: Pipeline([
         ('counts', TfidfVectorizer(
             min_df=MIN_OCCURANCE,
             max_df=MAX_OCCURANCE,
             binary=False)),
-        ('dense', FunctionTransformer(
-            lambda x: x.toarray(),
-            validate=False,
-            accept_sparse=True)),
-        ('model', xgb.XGBClassifier(objective="binary:logistic")),
+        ('dense', to_dense(sparse)),
+        # Entries missing from a CSR matrix are treated as missing by XGBoost,
+        # so zeros must be too for dense input (e.g. from explainers) to agree
+        ('model', xgb.XGBClassifier(
+            objective="binary:logistic",
+            missing=0.0 if sparse else np.nan)),
     ]),
 
     'mlp': lambda: Pipeline([
@@ -101,10 +109,8 @@ pipelines = {
             max_df=MAX_OCCURANCE,
             max_features=MLP_MAX_VOCAB,
             binary=False)),
-        ('dense', FunctionTransformer(
-            lambda x: x.toarray(),
-            validate=False,
-            accept_sparse=True)),
+        # skorch needs dense tensors
+        ('dense', to_dense()),
         ('model', WeightedNeuralNet(
             module=MLP,
             device='cuda',
@@ -190,6 +196,30 @@ class LSTM(nn.Module):
         return data
 
 
+class FeatureDataset(Dataset):
+    # Cached backbone features of a BirdDataset, one (n, d) float16 array per
+    # augmented view. Every item is drawn from a random view, so each epoch
+    # still sees one augmentation of every image
+    def __init__(self, views, labels, bias_labels, biased, sampler=None):
+        self.views = views
+        self.labels = labels
+        self.bias_labels = bias_labels
+        self.biased = biased
+        self.sampler = sampler
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        view = self.views[np.random.randint(len(self.views))]
+        return {
+            'image': torch.from_numpy(view[idx].astype(np.float32)),
+            'label': self.labels[idx],
+            'bias_label': self.bias_labels[idx],
+            'biased': self.biased[idx],
+        }
+
+
 class PretrainedModels:
     def __init__(self, num_classes, model_name, finetune=True):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -232,6 +262,46 @@ class PretrainedModels:
 
     def __call__(self, x):
         return self.model(x)
+
+    def _head(self):
+        if hasattr(self.model, 'fc'):
+            return self.model.fc
+        return self.model.classifier[1]
+
+    def _set_head(self, head):
+        if hasattr(self.model, 'fc'):
+            self.model.fc = head
+        else:
+            self.model.classifier[1] = head
+
+    def cache_features(self, loader, n_views=1):
+        # Runs the frozen backbone (in eval mode) over loader's dataset in
+        # order n_views times and returns it as a FeatureDataset. Views differ
+        # only if the dataset's transform is random
+        head = self._head()
+        self._set_head(nn.Identity())
+        self.model.eval()
+
+        ordered = make_dataloader(loader.dataset, loader.batch_size,
+                num_workers=loader.num_workers, persistent_workers=False,
+                ordered=True)
+        views = []
+        with torch.no_grad():
+            for view in range(n_views):
+                print('Caching features, view {}/{}'.format(view + 1, n_views))
+                features, labels, bias_labels, biased = [], [], [], []
+                for data in tqdm.tqdm(ordered):
+                    outputs = self.model(data['image'].to(self.device))
+                    features.append(outputs.half().cpu().numpy())
+                    labels.append(data['label'].numpy())
+                    bias_labels.append(data['bias_label'].numpy())
+                    biased.append(data['biased'].numpy())
+                views.append(np.concatenate(features))
+        self._set_head(head)
+
+        return FeatureDataset(views, np.concatenate(labels),
+                np.concatenate(bias_labels), np.concatenate(biased),
+                sampler=getattr(loader.dataset, 'sampler', None))
     #
     # def grad_all(self):
     #     for param in self.model.parameters():
@@ -244,122 +314,221 @@ class PretrainedModels:
             lr=0.001,
             momentum=0.9,
             num_epochs=20,
-            bias=False
+            bias=False,
+            batch_size=32,
+            num_workers=LOAD_WORKERS,
+            head_only=False,
+            n_views=HEAD_VIEWS
+    ):
+        model_name = 'bias' if bias else 'orig'
+        self._fit_heads({model_name: self}, dataloaders, runlog, lr=lr,
+                momentum=momentum, num_epochs=num_epochs, batch_size=batch_size,
+                num_workers=num_workers, head_only=head_only, n_views=n_views)
+
+    def fit_with_orig(self, orig_model, dataloaders, runlog, **kwargs):
+        # Trains self on bias_label and orig_model (same architecture) on
+        # label together. Both heads read the backbone output of one pass of
+        # self's backbone per batch, each keeps its own early stopping. Takes
+        # the keyword arguments of fit, except bias
+        self._fit_heads({'bias': self, 'orig': orig_model}, dataloaders, runlog,
+                **kwargs)
+
+    def _fit_heads(
+            self,
+            models,
+            dataloaders,
+            runlog,
+            lr=0.001,
+            momentum=0.9,
+            num_epochs=20,
+            batch_size=32,
+            num_workers=LOAD_WORKERS,
+            head_only=False,
+            n_views=HEAD_VIEWS
     ):
-        params_to_update = []
-        for param in self.model.parameters():
-            if param.requires_grad:
-                params_to_update.append(param)
+        # models maps 'bias' / 'orig' to the PretrainedModels trained on
+        # bias_label / label. Only their heads train, the frozen backbone of
+        # self is run once per batch (without gradients) and shared by all
+
+        # dataloaders maps 'train' and 'val' to DataLoaders or to datasets,
+        # which are loaded in parallel (train shuffled) by make_dataloader
+        dataloaders = {
+            phase: data if isinstance(data, DataLoader) else
+                make_dataloader(data, batch_size, shuffle=(phase == 'train'),
+                        num_workers=num_workers)
+            for phase, data in dataloaders.items()
+        }
+
+        # Head only: the backbone is frozen, so its features are computed once
+        # (n_views augmentations of train, one pass of val) and only the head
+        # is trained on them. The backbone stays in eval mode throughout
+        heads = {name: model._head() for name, model in models.items()}
+        if head_only:
+            n_views = {'train': n_views, 'val': 1}
+            dataloaders = {
+                phase: make_dataloader(
+                    self.cache_features(loader, n_views[phase]),
+                    loader.batch_size, shuffle=(phase == 'train'),
+                    num_workers=0)
+                for phase, loader in dataloaders.items()
+            }
+            self.model.eval()
+            backbone = nn.Identity()
+        else:
+            self._set_head(nn.Identity())
+            backbone = self.model
 
-        # optimizer = optim.SGD(params_to_update, lr=lr, momentum=momentum)
-        optimizer = optim.Adam(params_to_update, lr=lr)
         criterion = nn.CrossEntropyLoss()
 
-        best_model_wts = copy.deepcopy(self.model.state_dict())
-        best_f1 = 0.0
-        best_acc = 0.0
-        best_acc_R = 0.0
-        best_prec = 0.0
-        best_loss = float('inf')
-        best_score = 0.0
-
         def scoring(loss, f1, acc, acc_R):
             # return f1 # + (2 * acc_R)
             # return acc + acc_R
             return f1
 
-        model_name = 'bias' if bias else 'orig'
-        start_time = time.time()
+        # Training state of every head
         patience_start = 10
-        patience = patience_start
+        state = {}
+        for name, head in heads.items():
+            params_to_update = []
+            for param in head.parameters():
+                if param.requires_grad:
+                    params_to_update.append(param)
+
+            state[name] = {
+                # 'optimizer': optim.SGD(params_to_update, lr=lr, momentum=momentum),
+                'optimizer': optim.Adam(params_to_update, lr=lr),
+                'label': 'bias_label' if name == 'bias' else 'label',
+                'patience': patience_start,
+                'best_head_wts': copy.deepcopy(head.state_dict()),
+                'best_backbone_wts': copy.deepcopy(backbone.state_dict()),
+                'best_f1': 0.0,
+                'best_acc': 0.0,
+                'best_acc_R': 0.0,
+                'best_prec': 0.0,
+                'best_loss': float('inf'),
+                'best_score': 0.0,
+            }
+
+        start_time = time.time()
 
         for epoch in range(num_epochs):
-            if patience < 1:
+            training = [name for name in heads if state[name]['patience'] >= 1]
+            if not training:
                 break
-            print('{} Epoch {}/{} Patience {}'
-                    .format(model_name, epoch + 1, num_epochs, patience))
+            for name in training:
+                print('{} Epoch {}/{} Patience {}'.format(
+                        name, epoch + 1, num_epochs, state[name]['patience']))
             print('-' * 10)
             for phase in ['train', 'val']:
                 print('phase:', phase)
                 if phase == 'train':
-                    self.model.train()  # Set model to training mode
+                    # Set model to training mode
+                    if not head_only: backbone.train()
+                    for name in training: heads[name].train()
                 else:
-                    self.model.eval()   # Set model to evaluate mode
+                    # Set model to evaluate mode
+                    backbone.eval()
+                    for name in training: heads[name].eval()
 
-                running_loss = 0.0
-                y_true = []
-                y_pred = []
+                running_loss = {name: 0.0 for name in training}
+                y_true = {name: [] for name in training}
+                y_pred = {name: [] for name in training}
                 biased = []
 
                 for data in tqdm.tqdm(dataloaders[phase]):
-                    batch_size = len(data['label'])
-                    inputs = data['image']
-                    labels = data['bias_label'] if bias else data['label']
-                    inputs = inputs.to(self.device)
-                    labels = labels.to(self.device)
-                    optimizer.zero_grad()
-                    with torch.set_grad_enabled(phase == 'train'):
-                        outputs = self.model(inputs)
-                        loss = criterion(outputs, labels)
-                        _, preds = torch.max(outputs, 1)
-                        if phase == 'train':
-                            loss.backward()
-                            optimizer.step()
-
-                    running_loss += loss.item() * inputs.size(0)
-                    y_true.extend( labels.tolist() )
-                    y_pred.extend( preds.tolist() )
+                    inputs = data['image'].to(self.device)
+                    with torch.no_grad():
+                        features = backbone(inputs)
+
+                    for name in training:
+                        optimizer = state[name]['optimizer']
+                        labels = data[state[name]['label']].to(self.device)
+                        optimizer.zero_grad()
+                        with torch.set_grad_enabled(phase == 'train'):
+                            outputs = heads[name](features)
+                            loss = criterion(outputs, labels)
+                            _, preds = torch.max(outputs, 1)
+                            if phase == 'train':
+                                loss.backward()
+                                optimizer.step()
+
+                        running_loss[name] += loss.item() * inputs.size(0)
+                        y_true[name].extend( labels.tolist() )
+                        y_pred[name].extend( preds.tolist() )
                     biased.extend( data['biased'].tolist() )
 
-                y_true = np.array(y_true)
-                y_pred = np.array(y_pred)
                 biased = np.array(biased)
 
                 # Epoch scoring
-                epoch_loss = running_loss / len(dataloaders[phase].dataset)
-
-                acc    = accuracy_score(y_true, y_pred)
-                f1     = f1_score(y_true, y_pred)
-                acc_R  = accuracy_score(y_true[biased], y_pred[biased])
-                acc_NR = accuracy_score(y_true[~biased], y_pred[~biased])
-                prec   = precision_score(y_true, y_pred)
-                score = scoring(epoch_loss, f1, acc, acc_R)
-
-                fmt_string = 'Loss: {: >.4f} | Acc: {: >.4f} | F1: {: >.4f}'
-                fmt_string += ' | Acc (R): {: >.4f} | Acc (~R): {: >.4f}'
-                fmt_string += ' | Prec.: {: >.4f}'
-                print(fmt_string.format(epoch_loss, acc, f1, acc_R, acc_NR, prec))
+                scores = {}
+                for name in training:
+                    true = np.array(y_true[name])
+                    pred = np.array(y_pred[name])
+                    epoch_loss = running_loss[name] / len(dataloaders[phase].dataset)
+
+                    acc    = accuracy_score(true, pred)
+                    f1     = f1_score(true, pred)
+                    acc_R  = accuracy_score(true[biased], pred[biased])
+                    acc_NR = accuracy_score(true[~biased], pred[~biased])
+                    prec   = precision_score(true, pred)
+                    score = scoring(epoch_loss, f1, acc, acc_R)
+                    scores[name] = (score, epoch_loss, acc, f1, acc_R, prec)
+
+                    fmt_string = '{} Loss: {: >.4f} | Acc: {: >.4f} | F1: {: >.4f}'
+                    fmt_string += ' | Acc (R): {: >.4f} | Acc (~R): {: >.4f}'
+                    fmt_string += ' | Prec.: {: >.4f}'
+                    print(fmt_string.format(name, epoch_loss, acc, f1, acc_R,
+                            acc_NR, prec))
                 print()
 
             # if phase == 'val' and epoch_loss < best_loss:
-            if phase == 'val' and  score > best_score:
-                print(color.BOLD + ('^' * 30) + ' NEW BEST ' + ('^' * 30) + color.END)
-                print()
-                patience = patience_start
-                best_loss  = epoch_loss
-                best_acc_R = acc_R
-                best_acc   = acc
-                best_f1    = f1
-                best_prec  = prec
-                best_score = score
-                best_model_wts = copy.deepcopy(self.model.state_dict())
-            else:
-                patience -= 1
+            for name in training:
+                score, epoch_loss, acc, f1, acc_R, prec = scores[name]
+                best = state[name]
+                if phase == 'val' and score > best['best_score']:
+                    print(color.BOLD + ('^' * 30) + ' NEW BEST ({}) '.format(name)
+                            + ('^' * 30) + color.END)
+                    print()
+                    best['patience']   = patience_start
+                    best['best_loss']  = epoch_loss
+                    best['best_acc_R'] = acc_R
+                    best['best_acc']   = acc
+                    best['best_f1']    = f1
+                    best['best_prec']  = prec
+                    best['best_score'] = score
+                    best['best_head_wts'] = copy.deepcopy(heads[name].state_dict())
+                    # BatchNorm statistics of the backbone change in training
+                    best['best_backbone_wts'] = copy.deepcopy(backbone.state_dict())
+                else:
+                    best['patience'] -= 1
 
         # except KeyboardInterrupt:
         #     print('\nTraining canceled by user!')
         #     print('Press CTRL-C again within 5s to prevent saving model!')
         #     time.sleep(5)
 
-        self.model.load_state_dict(best_model_wts)
-        training_time = time.time() - start_time
-        runlog[model_name + '_training_time'] = training_time
-        print('Training finished in {:.2f} minutes'.format(training_time / 60))
-        print('Best val F1:    {:4f}'.format(best_f1))
-        print('Best val Acc:   {:4f}'.format(best_acc))
-        print('Best val Acc R: {:4f}'.format(best_acc_R))
-        print()
+        if not head_only:
+            own_name = [name for name in models if models[name] is self][0]
+            self._set_head(heads[own_name])
 
+        training_time = time.time() - start_time
+        for name, model in models.items():
+            best = state[name]
+            # Every model gets the backbone as of its own best epoch
+            if not head_only:
+                model._set_head(nn.Identity())
+                model.model.load_state_dict(best['best_backbone_wts'])
+                model._set_head(heads[name])
+            heads[name].load_state_dict(best['best_head_wts'])
+            model.model.eval()
+
+            runlog[name + '_training_time'] = training_time
+            print('{} training finished in {:.2f} minutes'.format(
+                    name, training_time / 60))
+            print('Best val F1:    {:4f}'.format(best['best_f1']))
+            print('Best val Acc:   {:4f}'.format(best['best_acc']))
+            print('Best val Acc R: {:4f}'.format(best['best_acc_R']))
+            print()
 
     def predict(self, inputs):
         inputs = inputs.to(self.device)
@@ -114,7 +114,10 @@ def main():
     args = get_arguments()
     logger = logging.getLogger(__name__)
     path = os.path.abspath(args.dir)
-    df = plot_utils.load_log_data(path, args.plot_type, logger)
+    df = plot_utils.load_log_data(path, args.plot_type, logger,
+            datasets=DATASET_ORDER, models=MODEL_ORDER,
+            explainers=EXPLAINER_ORDER, seeds=SEEDS,
+            use_cache=not args.no_cache)
 
     print(df.head())
 
@@ -344,6 +347,10 @@ def get_arguments():
         required=False,
         default=BIAS_LENGTH,
         help='bias length to plot (default = {})'.format(BIAS_LENGTH))
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='parse every log file again and do not write the log cache')
     args = parser.parse_args()
     return args
 
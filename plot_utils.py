@@ -1,6 +1,7 @@
 import os
 import json
 import logging
+import contextlib
 import argparse
 
 import numpy as np
@@ -9,6 +10,8 @@ import seaborn as sns
 import pandas as pd
 import matplotlib.pyplot as plt
 
+import utils
+
 real_names = {
     # Models
     'logistic'  : 'Logistic Regression',
@@ -59,58 +62,233 @@ real_names = {
 
 
 
-def load_log_data(log_directory, plot_type, logger):
+LOG_CACHE = '.log_cache_{}.npz'   # Parsed rows of a log tree, per plot type
+LOG_CACHE_VERSION = 1             # Bump when the parsing below changes
+
+BIAS_COLUMNS = [
+    'Seed',
+    'Dataset',
+    'Model',
+    'Bias Length',
+    'Model Bias',
+    'Region',
+    'Accuracy'
+]
+BUDGET_COLUMNS = [
+    'Seed',
+    'Dataset',
+    'Model',
+    'Bias Length',
+    'Explainer',
+    'Budget',
+    'Recall',
+]
+IMAGE_COLUMNS = [
+    'Intersect % (circle r=5)',
+    'Intersect % (circle r=10)',
+    'Intersect % (circle r=15)',
+    'Intersect %',
+]
+STRING_COLUMNS = ['Dataset', 'Model', 'Explainer', 'Model Bias', 'Region']
+
+
+# Parsed rows are cached in <log_directory>/.log_cache_<plot_type>.npz, with the
+# mtime and size of the file each row came from. Only new or changed files are
+# parsed again. The filters (lists of values, None keeps all) are applied to
+# the cached columns before the rest of the columns are loaded
+def load_log_data(log_directory, plot_type, logger, datasets=None, models=None,
+        explainers=None, seeds=None, use_cache=True):
     logger.info('Loading logs from: {}'.format(log_directory))
+    columns = BIAS_COLUMNS if plot_type == 'bias' else BUDGET_COLUMNS + IMAGE_COLUMNS
+    if explainers is not None:
+        explainers = list(explainers) + [real_names.get(e, e) for e in explainers]
+    filters = [
+        ('Dataset', datasets),
+        ('Model', models),
+        ('Explainer', explainers if plot_type != 'bias' else None),
+        ('Seed', seeds),
+    ]
+
+    files = _list_log_files(log_directory)
+    cache_path = os.path.join(log_directory, LOG_CACHE.format(plot_type))
+    # The cache is read lazily and closed before it is rewritten
+    with _open_log_cache(cache_path if use_cache else None, logger) as cache:
+        manifest = {}
+        if cache is not None:
+            for i, (path, mtime, size) in enumerate(
+                    zip(cache['files'], cache['mtimes'], cache['sizes'])):
+                manifest[path] = (i, (int(mtime), int(size)))
+
+        stale = [path for path in files if path not in manifest or
+                manifest[path][1] != files[path]]
+        if cache is not None and not stale and len(manifest) == len(files):
+            logger.info('All {} log files cached in: {}'.format(len(files), cache_path))
+            data = _filter_columns(cache, columns, filters)
+            return _columns_to_df(data, columns, plot_type)
+
+        # Keep the rows of unchanged files, parse the rest
+        logger.info('Parsing {} new or changed log files'.format(len(stale)))
+        paths = sorted(files)
+        file_ids = {path: i for i, path in enumerate(paths)}
+        data = {column: [] for column in columns}
+        data['file_id'] = []
+
+        if cache is not None:
+            old_ids = np.full(len(manifest), -1, dtype=np.int64)
+            for path, (i, stat) in manifest.items():
+                if files.get(path) == stat:
+                    old_ids[i] = file_ids[path]
+            new_file = old_ids[cache['file_id']]
+            keep = new_file >= 0
+            for column in columns:
+                data[column].append(_read_column(cache, column)[keep])
+            data['file_id'].append(new_file[keep])
+
+        for path in stale:
+            logger.debug('parsing: {}'.format(path))
+            rows = _parse_log_file(os.path.join(log_directory, path), plot_type, logger)
+            for j, column in enumerate(columns):
+                values = [row[j] if j < len(row) else np.nan for row in rows]
+                data[column].append(np.array(values,
+                        dtype=str if column in STRING_COLUMNS else np.float64))
+            data['file_id'].append(np.full(len(rows), file_ids[path], dtype=np.int64))
+
+    for column in data:
+        data[column] = np.concatenate(data[column]) if data[column] else np.array([])
+
+    if use_cache:
+        stats = np.array([files[path] for path in paths], dtype=np.int64).reshape(-1, 2)
+        _write_log_cache(cache_path, data, columns, paths, stats)
+        logger.info('Cached {} rows in: {}'.format(len(data['file_id']), cache_path))
+
+    data = _filter_columns(data, columns, filters)
+    return _columns_to_df(data, columns, plot_type)
+
+
+def _list_log_files(log_directory):
+    # Relative path -> (mtime, size) of every log file under log_directory
+    files = {}
+    for root, dirs, names in os.walk(log_directory):
+        # The sweep ledger (utils.ledger_path) is not a results file
+        dirs[:] = [d for d in dirs
+                if not d.startswith('.') and d != utils.LEDGER_DIR]
+        for name in names:
+            if name.startswith('.') or name.endswith('.tmp'):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, log_directory)] = \
+                    (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def _parse_log_file(path, plot_type, logger):
+    # Results stores hold many rows per file, save_log files hold one
+    if path.endswith('.jsonl'):
+        logs = utils.read_results(path)
+    else:
+        with open(path, 'r') as f:
+            try:
+                logs = [json.load(f)]
+            except Exception as e:
+                logger.error('Eailed to read file ' + path)
+                raise e
+
     rows = []
-    image_data = False
-    for root, _, files in os.walk(log_directory):
-        for f in files:
-            logger.debug('parsing: {}'.format(f))
-            path = os.path.join(root, f)
-            with open(path, 'r') as f:
-                try:
-                    data = json.load(f)
-                    if not image_data and 'intersect_percentage_segment' in data:
-                        image_data = True
-                except Exception as e:
-                    logger.error('Eailed to read file ' + path)
-                    raise e
-
-                if plot_type == 'bias':
-                    rows.extend(_log_to_df_bias(data))
-                else:
-                    rows.append(_log_to_df_budget(data))
-
-    if plot_type == 'bias':
-        columns = [
-            'Seed',
-            'Dataset',
-            'Model',
-            'Bias Length',
-            'Model Bias',
-            'Region',
-            'Accuracy'
-        ]
-        df = pd.DataFrame(columns=columns, data=rows)
+    for data in logs:
+        if plot_type == 'bias':
+            rows.extend(_log_to_df_bias(data))
+        else:
+            rows.append(_log_to_df_budget(data))
+    return rows
 
-    else:
-        columns = [
-            'Seed',
-            'Dataset',
-            'Model',
-            'Bias Length',
-            'Explainer',
-            'Budget',
-            'Recall',
-        ]
-        if image_data:
-            columns.extend([
-                'Intersect % (circle r=5)',
-                'Intersect % (circle r=10)',
-                'Intersect % (circle r=15)',
-                'Intersect %',
-            ])
-        df = pd.DataFrame(columns=columns, data=rows)
+
+@contextlib.contextmanager
+def _open_log_cache(cache_path, logger):
+    # Yields the open cache, or None if there is no usable one
+    if cache_path is None or not os.path.exists(cache_path):
+        yield None
+        return
+    try:
+        cache = np.load(cache_path)
+    except Exception:
+        logger.warning('Ignoring unreadable log cache: {}'.format(cache_path))
+        yield None
+        return
+    with cache:
+        try:
+            usable = int(cache['version']) == LOG_CACHE_VERSION
+        except Exception:
+            logger.warning('Ignoring unreadable log cache: {}'.format(cache_path))
+            usable = False
+        yield cache if usable else None
+
+
+def _write_log_cache(cache_path, data, columns, paths, stats):
+    # Strings are stored as codes into a table of unique values, no pickles
+    arrays = {
+        'version': np.array(LOG_CACHE_VERSION),
+        'files': np.array(paths, dtype=str),
+        'mtimes': stats[:, 0],
+        'sizes': stats[:, 1],
+        'file_id': data['file_id'],
+    }
+    for column in columns:
+        if column in STRING_COLUMNS:
+            values, codes = np.unique(data[column], return_inverse=True)
+            arrays[column + '/values'] = values
+            arrays[column + '/codes'] = codes.astype(np.int32)
+        else:
+            arrays[column] = data[column]
+
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, cache_path)
+
+
+def _read_column(source, column, mask=None):
+    # source is either an open cache (loaded lazily, per array) or a dict of
+    # decoded columns
+    if isinstance(source, dict):
+        values = source[column]
+        return values if mask is None else values[mask]
+    if column in STRING_COLUMNS:
+        codes = source[column + '/codes']
+        codes = codes if mask is None else codes[mask]
+        return source[column + '/values'][codes]
+    values = source[column]
+    return values if mask is None else values[mask]
+
+
+def _filter_columns(source, columns, filters):
+    mask = None
+    for column, keep in filters:
+        if keep is None:
+            continue
+        values = _read_column(source, column)
+        if column not in STRING_COLUMNS:
+            keep = np.array(keep, dtype=np.float64)
+        matches = np.isin(values, keep)
+        mask = matches if mask is None else mask & matches
+    return {column: _read_column(source, column, mask) for column in columns}
+
+
+def _columns_to_df(data, columns, plot_type):
+    if plot_type != 'bias':
+        # Only image logs have intersections
+        image_data = any(np.any(~np.isnan(data[column])) for column in IMAGE_COLUMNS)
+        if not image_data:
+            columns = BUDGET_COLUMNS
+
+    df = pd.DataFrame({column: data[column] for column in columns},
+            columns=columns)
+    for column in ['Seed', 'Bias Length', 'Budget']:
+        if column in df.columns:
+            df[column] = df[column].astype(int)
+    for column in STRING_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype(object)
     return df
 
 
@@ -17,6 +17,7 @@ from torch.utils.data import Dataset
 
 from explainers import SmoothGradExplainer, VanillaGradExplainer
 from models import PretrainedModels
+from image_utils import ImageStore, make_dataloader
 
 # from models import PretrainedModels
 
@@ -63,10 +64,12 @@ def main():
         "vanilla": VanillaGradExplainer,
     }
 
+    # Loaded in the main process: the datasets explain with the base model and
+    # switch explainers between passes, state persistent workers would miss
     dataloaders_dict = {
-        split: torch.utils.data.DataLoader(
+        split: make_dataloader(
             RoarBirdDataset(split, explainers),
-            batch_size=BATCH_SIZE,
+            BATCH_SIZE,
             shuffle=False,
             num_workers=0,
         )
@@ -187,6 +190,9 @@ class RoarBirdDataset(Dataset):
         data.dropna(inplace=True)
         data.reset_index(drop=True, inplace=True)
 
+        # Decoded once, shared by every split and ROAR retraining
+        self.store = ImageStore(self.data_dir, data["img_id"], data["img_path"])
+
         # Train / Val / Test Split ############################################
         if split != "full":
             train_test_data = pd.read_csv(
@@ -214,6 +220,7 @@ class RoarBirdDataset(Dataset):
 
         data.reset_index(drop=True, inplace=True)
         self.data = data
+        self.store_rows = self.store.rows(data["img_id"])
         self.explainers = explainers
 
         self.percentage_masked = 0
@@ -234,10 +241,7 @@ class RoarBirdDataset(Dataset):
         label = row["label"].astype(int)
         path = row["img_path"]
 
-        with open(self.data_dir + "images/" + path, "rb") as f:
-            image_file = Image.open(f)
-            image_rgb = image_file.convert("RGB")
-            image_rgb = np.array(image_rgb)
+        image_rgb = self.store.image(self.store_rows[idx])
 
         transformed = self.transform(image=image_rgb, keypoints=[])
         image = transformed["image"]
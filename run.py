@@ -1,6 +1,10 @@
 import os
 import sys
+import time
+import pickle
+import hashlib
 import argparse
+import functools
 from multiprocessing import Pool
 
 import tqdm
@@ -10,7 +14,8 @@ import torch
 
 import utils
 import biases
-from models import pipelines
+import features
+from models import pipelines, SPARSE, SPARSE_MODELS
 from explainers import (
     GreedyExplainer,
     LimeExplainer,
@@ -38,6 +43,7 @@ MIN_R_PERFOMANCE = 0.90         # Minimum accuracy on region R to allow
 MIN_F1_SCORE = 0.50             # Minimum F1-score to allow for biased model
 MAX_RETRIES = 3                 # Maximum retries if model performance is low
 BIAS_LENS = range(2, 3)         # Range of bias lengths to run
+STAIN_DIR = 'stains'            # Trained stains shared by their explainer units
 
  # Path to toy dataset for testing this scripts functionality
 # TOY_DATASET = 'datasets/newsgroups_atheism.csv'
@@ -52,6 +58,41 @@ MODELS = [
     # 'mlp',
 ]
 
+# Explainers run by each budget test, each one is a separate unit of work
+TEST_EXPLAINERS = {
+    'budget_test': {
+        # 'Random': RandomExplainer,
+        'Greedy': GreedyExplainer,
+        'LIME': LimeExplainer,
+        'SHAP': ShapExplainer,
+    },
+    'boost_test': {
+        'Greedy': GreedyExplainer,
+        'LIME': LimeExplainer,
+        'SHAP': ShapExplainer,
+        'Aggregate (LIME x 3)': BaggedLimeExplainer,
+        'Aggregate (SHAP x 3)': BaggedShapExplainer,
+    },
+}
+
+# Interpretable models also get their respective explainer
+GROUND_TRUTH = {
+    'logistic': LogisticExplainer,
+    'dt': TreeExplainer,
+}
+
+# Rough relative costs of units, used to start the longest units first
+MODEL_COSTS = { 'logistic': 1, 'dt': 1, 'rf': 4, 'xgb': 4, 'mlp': 8 }
+EXPLAINER_COSTS = {
+    'Ground Truth': 1,
+    'Random': 1,
+    'Greedy': 5,
+    'LIME': 10,
+    'SHAP': 20,
+    'Aggregate (LIME x 3)': 30,
+    'Aggregate (SHAP x 3)': 60,
+}
+
 # Test types handled by this script
 TESTS = [ 'bias_test', 'budget_test', 'boost_test' ]
 
@@ -72,49 +113,120 @@ def main():
         for filename in os.listdir(args.data_dir):
             datasets.append(os.path.join(args.data_dir, filename))
 
-    # Build list of arguments
-    arguments = []
+    # Explanations are recorded per explainer, units completed by earlier runs
+    # of this sweep are skipped
+    ledger = None
+    if not args.no_log:
+        ledger = utils.TaskLedger(utils.ledger_path(args.log_dir, args.test))
+
+    # Every stain (seed, dataset, model, bias_len) is trained once. Each of its
+    # pending explainers is then a separate unit that loads the saved stain,
+    # so the explainers of all stains are spread across the workers
+    stains = []
+    units = []
+    n_skipped = 0
     for seed in range(args.seed_low, args.seed_high):
         for dataset in datasets:
             for model_type in MODELS:
                 for bias_len in BIAS_LENS:
-                    arguments.append({
+                    arg = {
                         'seed': seed,
                         'dataset': dataset,
                         'model_type': model_type,
-                        'bias_length': bias_len
-                    })
-
-    print(arguments)
-
+                        'bias_length': bias_len,
+                    }
+                    pending = []
+                    for explainer in unit_explainers(model_type):
+                        if ledger is not None and ledger.done(unit_of(arg, explainer)):
+                            n_skipped += 1
+                        else:
+                            pending.append(explainer)
+                    if not pending:
+                        continue
+                    if args.test not in TEST_EXPLAINERS:
+                        stains.append(arg)      # bias_test, training is the unit
+                        continue
+                    if not os.path.exists(stain_path(arg)):
+                        stains.append(arg)
+                    for explainer in pending:
+                        units.append(dict(arg, explainer=explainer))
+    print('Skipping {} completed units'.format(n_skipped))
+
+    # Longest first, so they do not straggle at the end
+    stains.sort(key=unit_cost, reverse=True)
+    units.sort(key=unit_cost, reverse=True)
+
+    print('Training {} stains...'.format(len(stains)))
+    run_pool(run_seed, stains, pool_size)
+    print('Explaining {} units...'.format(len(units)))
+    run_pool(explain_unit, units, pool_size)
+
+    # Workers append completed units to the ledger as they finish them
+    if not args.no_log:
+        completed = utils.TaskLedger(utils.ledger_path(args.log_dir, args.test))
+        utils.compact_results(args.log_dir, args.test,
+                completed=completed.completed, quiet=args.quiet)
+
+
+def run_pool(function, arguments, pool_size):
     if pool_size == 1:
-        for arg in arguments:
-            run_seed(arg)
+        for arg in tqdm.tqdm(arguments):
+            function(arg)
     else:
         pool = Pool(pool_size, maxtasksperchild=1)
-        imap_results = pool.imap(run_seed, arguments, chunksize=1)
+        imap_results = pool.imap_unordered(function, arguments, chunksize=1)
         list(tqdm.tqdm(imap_results, total=len(arguments)))
         pool.close()
         pool.join()
 
 
+def stain_path(arguments):
+    key = unit_of(arguments, None).encode('utf-8')
+    filename = hashlib.sha1(key).hexdigest() + '.pkl'
+    return os.path.join(args.stain_dir, args.test, filename)
+
+
+def unit_explainers(model_type):
+    # bias_test trains and evaluates once, budget tests split per explainer
+    if args.test not in TEST_EXPLAINERS:
+        return [None]
+    return list(test_explainers(args.test, model_type))
+
+
+def test_explainers(test, model_type):
+    exps = dict(TEST_EXPLAINERS[test])
+    if model_type in GROUND_TRUTH:
+        exps['Ground Truth'] = GROUND_TRUTH[model_type]
+    return exps
+
+
+def unit_of(arguments, explainer):
+    return utils.unit_key(
+            seed=arguments['seed'],
+            dataset=os.path.basename(arguments['dataset']),
+            model_type=arguments['model_type'],
+            bias_length=arguments['bias_length'],
+            explainer=explainer)
+
+
+def unit_cost(arguments):
+    # Stains are costed as training, units as their explainer
+    cost = os.path.getsize(arguments['dataset'])
+    cost *= MODEL_COSTS.get(arguments['model_type'], 1)
+    cost *= EXPLAINER_COSTS.get(arguments.get('explainer'), 1)
+    return cost
+
+
 def run_seed(arguments):
     seed = arguments['seed']
     dataset = arguments['dataset']
     model_type = arguments['model_type']
     bias_length = arguments['bias_length']
 
-    if 'train_attempts' not in arguments:
-        np.random.seed(seed)
-        os.environ['MKL_NUM_THREADS'] = '1'
-        torch.set_num_threads(1)
-        arguments['train_attempts'] = 1
-
-    elif arguments['train_attempts'] > MAX_RETRIES:
-        pass
-        # assert False, 'Exceeded maximum number of retries, bias failed'
-
-    print('\tTRAIN_ATTEMPTS = {}'.format(arguments['train_attempts']))
+    np.random.seed(seed)
+    os.environ['MKL_NUM_THREADS'] = '1'
+    torch.set_num_threads(1)
+    start_time = time.time()
 
     # Building Runlog dictionary with seed args
     runlog = {}
@@ -126,65 +238,18 @@ def run_seed(arguments):
     runlog['min_occur']  = MIN_OCCURANCE
     runlog['max_occur']  = MAX_OCCURANCE
 
-    model_orig, \
-    model_bias, \
-    train_df,   \
-    test_df,    \
-    bias_words = build_biased_model(dataset, model_type, bias_length, runlog)
-
-    # Evaluate both models on biased region R and ~R
-    utils.evaluate_models(model_orig, model_bias, test_df, runlog, quiet=args.quiet)
-    utils.evaluate_models_test(model_orig, model_bias, test_df, runlog, quiet=args.quiet)
-
-    R_bias_acc = runlog['results'][1][0]
-    bias_f1 = runlog['bias_test_f1']
-    if R_bias_acc < MIN_R_PERFOMANCE and arguments['train_attempts'] <= MAX_RETRIES:
-        print('Accuracy on region R too low (expected >= {}, got {})'.format(
-            MIN_R_PERFOMANCE, R_bias_acc))
-        arguments['train_attempts'] += 1
-        run_seed(arguments)
-        return
-
-    if bias_f1 < MIN_F1_SCORE and arguments['train_attempts'] <= MAX_RETRIES:
-        print('F1-score too low on biased model (expected >= {}, got {})'.format(
-            MIN_F1_SCORE, bias_f1))
-        arguments['train_attempts'] += 1
-        run_seed(arguments)
-        return
-
-    if (not args.no_log) and args.test == 'bias_test':
-        utils.save_log(args.log_dir, runlog, quiet=args.quiet)
-        return
-
-    if args.test == 'budget_test':
-        exps = {
-            # 'Random': RandomExplainer,
-            'Greedy': GreedyExplainer,
-            'LIME': LimeExplainer,
-            'SHAP':ShapExplainer,
-        }
-        n_samples = 1 if args.toy else N_SAMPLES
-        explainers_budget_test(model_bias, exps, bias_words, train_df, n_samples, runlog)
-        return
-
-    if args.test ==  'boost_test':
-        exps = {
-            'Greedy': GreedyExplainer,
-            'LIME': LimeExplainer,
-            'SHAP':ShapExplainer,
-            'Aggregate (LIME x 3)': BaggedLimeExplainer,
-            'Aggregate (SHAP x 3)': BaggedShapExplainer,
-        }
-        n_samples = 1 if args.toy else N_SAMPLES
-        explainers_budget_test(model_bias, exps, bias_words, train_df, n_samples, runlog)
-        return
+    cache = None
+    if not args.no_cache:
+        cache = features.FeatureCache(args.cache_dir, dataset, seed)
 
-
-def build_biased_model(dataset_path, model_type, bias_length, runlog):
     reviews_train, \
     reviews_test,  \
     labels_train,  \
-    labels_test = utils.load_dataset(dataset_path, TRAIN_SIZE, runlog, quiet=args.quiet)
+    labels_test = utils.load_dataset(dataset, TRAIN_SIZE, runlog, quiet=args.quiet)
+
+    # Tokenize the training split once, the stain and both models derive
+    # their vocabularies and matrices from the same counts
+    shared = features.SharedCounts(reviews_train, cache=cache)
 
     bias_obj = biases.ComplexBias(
             reviews_train,
@@ -193,16 +258,106 @@ def build_biased_model(dataset_path, model_type, bias_length, runlog):
             BIAS_MIN_DF,
             BIAS_MAX_DF,
             runlog,
-            quiet=args.quiet)
-
-    train_df = bias_obj.build_df(reviews_train, labels_train, runlog)
-    test_df = bias_obj.build_df(reviews_test, labels_test, runlog)
+            quiet=args.quiet,
+            cache=shared)
 
+    # A retry only redraws the stain and retrains the stained model, the split,
+    # the fitted vectorizers and the original model are kept
     model_pipeline = pipelines[model_type]
-    model_orig, model_bias = utils.train_models(model_pipeline, train_df, runlog,
-            quiet=args.quiet)
+    runlog['sparse'] = args.sparse and model_type in SPARSE_MODELS
+    if model_type in SPARSE_MODELS:
+        model_pipeline = functools.partial(model_pipeline, sparse=runlog['sparse'])
+    runlog['stain_attempts'] = []
+    for train_attempt in range(1, MAX_RETRIES + 2):
+        print('\tTRAIN_ATTEMPTS = {}'.format(train_attempt))
+        attempt_start = time.time()
+        if train_attempt > 1:
+            bias_obj.redraw(runlog)
+
+        train_df = bias_obj.build_df(reviews_train, labels_train, runlog)
+        test_df = bias_obj.build_df(reviews_test, labels_test, runlog)
+        if train_attempt == 1:
+            model_orig, model_bias = utils.train_models(model_pipeline, train_df,
+                    runlog, quiet=args.quiet, cache=shared)
+        else:
+            model_bias = utils.train_models(model_pipeline, train_df, runlog,
+                    bias_only=True, quiet=args.quiet, cache=shared,
+                    counts=model_orig.steps[0][1])
+
+        # Evaluate both models on biased region R and ~R
+        utils.evaluate_models(model_orig, model_bias, test_df, runlog,
+                quiet=args.quiet, cache=shared)
+        utils.evaluate_models_test(model_orig, model_bias, test_df, runlog, quiet=args.quiet)
+
+        R_bias_acc = runlog['results'][1][0]
+        bias_f1 = runlog['bias_test_f1']
+        runlog['stain_attempts'].append({
+            'bias_words': list(bias_obj.bias_words),
+            'R_bias_acc': float(R_bias_acc),
+            'bias_f1': float(bias_f1),
+            'seconds': time.time() - attempt_start,
+        })
+
+        if R_bias_acc < MIN_R_PERFOMANCE:
+            print('Accuracy on region R too low (expected >= {}, got {})'.format(
+                MIN_R_PERFOMANCE, R_bias_acc))
+        elif bias_f1 < MIN_F1_SCORE:
+            print('F1-score too low on biased model (expected >= {}, got {})'.format(
+                MIN_F1_SCORE, bias_f1))
+        else:
+            break
+
+    # After MAX_RETRIES the last stain is used regardless
+    runlog['train_attempts'] = train_attempt
+    bias_words = bias_obj.bias_words
+
+    if args.test == 'bias_test':
+        if not args.no_log:
+            utils.save_log(args.log_dir, runlog, quiet=args.quiet)
+            # One file per unit, nothing to compact
+            ledger = utils.TaskLedger(utils.ledger_path(args.log_dir, args.test))
+            ledger.record(unit_of(arguments, None), args.test,
+                    time.time() - start_time)
+        return
 
-    return model_orig, model_bias, train_df, test_df, bias_obj.bias_words
+    # Saved for the explainer units, written whole or not at all
+    path = stain_path(arguments)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    stain = {
+        'model_bias': model_bias,
+        'bias_words': bias_words,
+        'train_df': train_df,
+        'runlog': runlog,
+    }
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(stain, f)
+    os.replace(tmp_path, path)
+
+
+def explain_unit(arguments):
+    # One explainer over a stain saved by run_seed
+    np.random.seed(arguments['seed'])
+    os.environ['MKL_NUM_THREADS'] = '1'
+    torch.set_num_threads(1)
+    start_time = time.time()
+
+    with open(stain_path(arguments), 'rb') as f:
+        stain = pickle.load(f)
+
+    explainer = arguments['explainer']
+    exps = test_explainers(args.test, arguments['model_type'])
+    n_samples = 1 if args.toy else N_SAMPLES
+    unit = unit_of(arguments, explainer)
+    attempt = explainers_budget_test(stain['model_bias'],
+            {explainer: exps[explainer]}, stain['bias_words'],
+            stain['train_df'], n_samples, stain['runlog'], unit=unit)
+
+    # Recorded as soon as it is logged, a restart only redoes missing units
+    if attempt is not None:
+        ledger = utils.TaskLedger(utils.ledger_path(args.log_dir, args.test))
+        ledger.record(unit, attempt, time.time() - start_time)
 
 
 def explainers_budget_test(
@@ -211,7 +366,8 @@ def explainers_budget_test(
     bias_words,
     train_df,
     n_samples,
-    runlog
+    runlog,
+    unit=None
 ):
     X_all = train_df['reviews'].values
     explain = train_df[ train_df['biased'] & train_df['flipped'] ]
@@ -220,23 +376,36 @@ def explainers_budget_test(
     runlog['n_samples'] = n_samples
     bias_length = len(bias_words)
 
-    # Handle interpretable models by adding their respective explainer
-    if runlog['model_type'] == 'logistic':
-        explainers['Ground Truth'] = LogisticExplainer
-    elif runlog['model_type'] == 'dt':
-        explainers['Ground Truth'] = TreeExplainer
+    budgets = list(range(1, MAX_BUDGET + 1))
+
+    # Returns the id of the logged attempt, None when not logging
+    attempt = None
+    if not args.no_log:
+        results = utils.ResultsWriter(args.log_dir, runlog['test_name'],
+                quiet=args.quiet)
+        attempt = results.start_run(runlog, unit=unit)
 
     # Compute recall of exapliners
     for explainer_name in explainers:
         runlog['explainer'] = explainer_name
         explainer = explainers[explainer_name](model_bias, X_all)
-        for budget in range(1, MAX_BUDGET + 1):
-            runlog['budget'] = budget
-
-            # Compute the average recall over `n_samples` instances
-            avg_recall = 0
-            for i in range(n_samples):
-                importance_pairs = explainer.explain(X_explain[i], budget)
+        if isinstance(explainer, LimeExplainer):
+            runlog['lime_feature_selection'] = explainer.feature_selection
+
+        def explain(i):
+            # Explain each instance once and take every budget as a prefix of
+            # the ranking, unless the explainer fits itself to the budget
+            if explainer.budget_dependent:
+                return [explainer.explain(X_explain[i], b) for b in budgets]
+            ranking = explainer.rank(X_explain[i])
+            return [ranking[:b] for b in budgets]
+
+        explanations = utils.map_instances(explain, n_samples, runlog['seed'],
+                args.explain_workers, quiet=args.quiet)
+
+        for i in range(n_samples):
+            for budget, importance_pairs in zip(budgets, explanations[i]):
+                runlog['budget'] = budget
                 top_feats = [str(feat) for feat, _ in importance_pairs]
                 importances = [float(imp) for _, imp in importance_pairs]
                 runlog['top_features'] = top_feats
@@ -249,7 +418,11 @@ def explainers_budget_test(
                 runlog['recall'] = recall / bias_length
 
                 if not args.no_log:
-                    utils.save_log(args.log_dir, runlog, quiet=args.quiet)
+                    results.write(runlog)
+
+    if not args.no_log:
+        results.close()
+    return attempt
 
 
 def setup_args():
@@ -286,6 +459,35 @@ def setup_args():
         metavar='DATA_DIR',
         default=DATA_DIR,
         help='Dataset directory (default = {})'.format(DATA_DIR))
+    parser.add_argument(
+        '--explain-workers',
+        type=int,
+        metavar='N',
+        default=1,
+        help='Processes to explain instances with, per task (default = 1)')
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        metavar='CACHE_DIR',
+        default=features.CACHE_DIR,
+        help='Featurization cache directory (default = {})'.format(
+            features.CACHE_DIR))
+    parser.add_argument(
+        '--stain-dir',
+        type=str,
+        metavar='STAIN_DIR',
+        default=STAIN_DIR,
+        help='Directory of trained stains (default = {})'.format(STAIN_DIR))
+    parser.add_argument(
+        '--sparse',
+        action='store_true',
+        default=SPARSE,
+        help='Train models that accept it on sparse features (xgb then '
+             'treats zeros as missing)')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read or write the featurization cache')
     parser.add_argument(
         '--quiet',
         action='store_true',
@@ -311,6 +513,10 @@ def setup_args():
     bad_seed_msg = 'No seeds in [{}, {})'.format(args.seed_low, args.seed_high)
     assert (args.seed_low < args.seed_high), bad_seed_msg
 
+    # Workers of the seed pool are daemonic and can not fork explainer workers
+    nested_msg = 'Use either N_WORKERS > 1 or --explain-workers > 1, not both'
+    assert (args.n_workers == 1 or args.explain_workers <= 1), nested_msg
+
     return args
 
 
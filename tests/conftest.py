@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The repository targets scikit-learn versions that still have
+# get_feature_names, newer ones only have get_feature_names_out
+from sklearn.feature_extraction.text import CountVectorizer
+if not hasattr(CountVectorizer, 'get_feature_names'):
+    CountVectorizer.get_feature_names = \
+            lambda self: list(self.get_feature_names_out())
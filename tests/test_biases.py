@@ -0,0 +1,81 @@
+import itertools
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from biases import ComplexBias, CooccurrenceIndex
+
+
+def random_matrix(n_docs, n_words, seed):
+    # Binary document-term matrix with word frequencies from 5% to 60%
+    rng = np.random.RandomState(seed)
+    p = np.linspace(0.05, 0.6, n_words)
+    return sp.csr_matrix((rng.rand(n_docs, n_words) < p).astype(np.int64))
+
+
+def brute_force(vec, k, min_df, max_df):
+    dense = vec.toarray() > 0
+    found = []
+    for idxs in itertools.combinations(range(vec.shape[1]), k):
+        joint = int(np.all(dense[:, idxs], axis=1).sum())
+        if min_df <= joint <= max_df:
+            found.append((idxs, joint))
+    return found
+
+
+@pytest.mark.parametrize('k', [1, 2, 3, 4])
+@pytest.mark.parametrize('min_df,max_df', [(1, 200), (10, 200), (10, 30)])
+def test_candidates_match_brute_force(k, min_df, max_df):
+    vec = random_matrix(200, 14, k)
+    index = CooccurrenceIndex(vec)
+    got = list(index.candidates(k, min_df, max_df))
+    assert got == brute_force(vec, k, min_df, max_df)
+
+
+def test_sample_is_a_candidate():
+    vec = random_matrix(200, 14, 0)
+    index = CooccurrenceIndex(vec)
+    expected = dict(brute_force(vec, 3, 10, 40))
+    np.random.seed(0)
+    for _ in range(20):
+        idxs, joint = index.sample(3, 10, 40)
+        assert expected[tuple(sorted(idxs))] == joint
+
+
+def loop_stain(bias, vec, labels):
+    # Per-row staining ComplexBias.bias started from
+    bias_labels = []
+    biased = []
+    flipped = []
+    for i in range(vec.shape[0]):
+        instance = vec[i].toarray()[0]
+        if np.all(instance[bias.bias_idxs] > 0):
+            bias_labels.append(bias.bias_label)
+            biased.append(True)
+            flipped.append(bias.bias_label != labels[i])
+        else:
+            bias_labels.append(labels[i])
+            biased.append(False)
+            flipped.append(False)
+    return bias_labels, biased, flipped
+
+
+@pytest.mark.parametrize('bias_len', [1, 2, 3])
+def test_stain_matches_loop(bias_len):
+    rng = np.random.RandomState(bias_len)
+    words = ['w{}'.format(i) for i in range(12)]
+    p = np.linspace(0.2, 0.6, len(words))
+    reviews = [' '.join(w for w, keep in zip(words, rng.rand(len(words)) < p)
+                        if keep) or 'empty'
+               for _ in range(300)]
+    labels = rng.randint(0, 2, size=len(reviews))
+
+    np.random.seed(bias_len)
+    bias = ComplexBias(reviews, labels, bias_len, 0.1, 0.7, {}, quiet=True)
+    vec = bias.vectorizer.transform(reviews)
+    expected = loop_stain(bias, vec, labels)
+    got = bias.stain(vec, labels)
+    for e, g in zip(expected, got):
+        assert np.array_equal(np.asarray(e), g)
+    assert got[1].sum() >= 10
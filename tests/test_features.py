@@ -0,0 +1,34 @@
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+
+import features
+
+
+def test_refit_under_same_entry_is_not_stale(tmp_path):
+    data_path = tmp_path / 'data.csv'
+    data_path.write_text('reviews,labels\n')
+    cache_dir = str(tmp_path / 'cache')
+
+    corpus_a = ['apple banana', 'banana cherry', 'apple cherry date']
+    corpus_b = ['egg fig', 'fig grape apple', 'egg grape']
+    test_docs = ['apple fig grape', 'banana egg', 'cherry date fig']
+
+    # Two runs share the cache entry (same dataset, seed and parameters), the
+    # second refits it on another corpus and caches the test matrix first
+    cache_a = features.FeatureCache(cache_dir, str(data_path), 0)
+    vectorizer_a = CountVectorizer()
+    cache_a.fit_transform(vectorizer_a, corpus_a)
+
+    cache_b = features.FeatureCache(cache_dir, str(data_path), 0)
+    vectorizer_b = CountVectorizer()
+    cache_b.fit_transform(vectorizer_b, corpus_b)
+    cache_b.transform(vectorizer_b, test_docs)
+
+    # The first run still gets matrices over its own vocabulary
+    expected = vectorizer_a.transform(test_docs).toarray()
+    got = cache_a.transform(vectorizer_a, test_docs).toarray()
+    assert np.array_equal(got, expected)
+
+    expected = vectorizer_b.transform(test_docs).toarray()
+    got = cache_b.transform(vectorizer_b, test_docs).toarray()
+    assert np.array_equal(got, expected)
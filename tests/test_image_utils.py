@@ -0,0 +1,55 @@
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import image_utils
+
+
+def make_images(data_dir, shapes):
+    os.makedirs(os.path.join(data_dir, 'images'))
+    rng = np.random.RandomState(0)
+    paths = []
+    for i, (height, width) in enumerate(shapes):
+        path = '{}.jpg'.format(i)
+        pixels = rng.randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(data_dir, 'images', path))
+        paths.append(path)
+    return paths
+
+
+def test_image_store_matches_decoded_images(tmp_path):
+    data_dir = str(tmp_path) + '/'
+    shapes = [(300, 500), (500, 300), (64, 80), (320, 320)]
+    paths = make_images(data_dir, shapes)
+    img_ids = [7, 3, 5, 1]
+    size = 96
+
+    store = image_utils.ImageStore(data_dir, img_ids, paths, size=size)
+    rows = store.rows(img_ids)
+    for row, path, (height, width) in zip(rows, paths, shapes):
+        image = store.image(row)
+
+        # Shorter side is size, aspect ratio is kept
+        assert min(image.shape[:2]) == size
+        assert abs(image.shape[0] / image.shape[1] - height / width) < 0.02
+
+        # Same pixels as resizing the decoded image on the fly
+        decoded = image_utils.read_image(os.path.join(data_dir, 'images', path))
+        assert decoded.shape[:2] == (height, width)
+        expected = cv2.resize(decoded, image.shape[1::-1],
+                interpolation=cv2.INTER_LINEAR)
+        assert image.dtype == np.uint8
+        assert np.array_equal(image, expected)
+
+    # Corners of the original images map to corners of the stored ones
+    corners = [(width, height) for height, width in shapes]
+    scaled = store.scale_keypoints(rows, corners)
+    stored = [store.image(row).shape[1::-1] for row in rows]
+    assert np.allclose(scaled, stored)
+
+    # A second store over the same images is read back, not rebuilt
+    again = image_utils.ImageStore(data_dir, img_ids[::-1], paths[::-1], size=size)
+    assert again.directory == store.directory
+    assert np.array_equal(again.image(again.rows([5])[0]), store.image(rows[2]))
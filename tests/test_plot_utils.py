@@ -0,0 +1,68 @@
+import logging
+
+import utils
+import plot_utils
+
+
+def write_unit(log_dir, test, explainer, seed):
+    runlog = {
+        'seed': seed,
+        'dataset': 'toy',
+        'model_type': 'rf',
+        'bias_len': 2,
+        'test_name': test,
+    }
+    results = utils.ResultsWriter(log_dir, test, quiet=True)
+    unit = utils.unit_key(seed=seed, explainer=explainer)
+    runlog['explainer'] = explainer
+    attempt = results.start_run(runlog, unit=unit)
+    for budget in range(1, 4):
+        runlog['budget'] = budget
+        runlog['recall'] = budget / 4
+        results.write(runlog)
+    results.close()
+    return unit, attempt
+
+
+def test_load_log_data_skips_ledger(tmp_path):
+    log_dir = str(tmp_path)
+    test = 'budget_test'
+    ledger = utils.TaskLedger(utils.ledger_path(log_dir, test))
+
+    # One unit compacted into results.jsonl, one still in a shard
+    unit, attempt = write_unit(log_dir, test, 'LIME', 0)
+    ledger.record(unit, attempt, 1.0)
+    utils.compact_results(log_dir, test, completed=ledger.completed, quiet=True)
+    unit, attempt = write_unit(log_dir, test, 'SHAP', 1)
+    ledger.record(unit, attempt, 1.0)
+
+    logger = logging.getLogger('test')
+    df = plot_utils.load_log_data(log_dir, 'budget', logger, use_cache=False)
+    assert len(df) == 6
+    assert sorted(df['Seed'].unique()) == [0, 1]
+
+
+def test_load_log_data_closes_cache(tmp_path, monkeypatch):
+    log_dir = str(tmp_path)
+    write_unit(log_dir, 'budget_test', 'LIME', 0)
+    logger = logging.getLogger('test')
+
+    opened = []
+    load = plot_utils.np.load
+    def tracking_load(*args, **kwargs):
+        opened.append(load(*args, **kwargs))
+        return opened[-1]
+    monkeypatch.setattr(plot_utils.np, 'load', tracking_load)
+
+    # Parsed, then fully cached, then partly cached
+    df = plot_utils.load_log_data(log_dir, 'budget', logger)
+    assert len(df) == 3
+    df = plot_utils.load_log_data(log_dir, 'budget', logger)
+    assert len(df) == 3
+    write_unit(log_dir, 'budget_test', 'SHAP', 1)
+    df = plot_utils.load_log_data(log_dir, 'budget', logger)
+    assert len(df) == 6
+    assert sorted(df['Seed'].unique()) == [0, 1]
+
+    assert len(opened) == 2
+    assert all(cache.fid is None for cache in opened)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from sklearn.metrics import accuracy_score, f1_score
+
+import utils
+
+REGIONS = {None: lambda biased: np.ones_like(biased, dtype=bool),
+           'R': lambda biased: biased,
+           'NR': lambda biased: ~biased}
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_matches_sklearn(weighted):
+    rng = np.random.RandomState(0)
+    n = 500
+    biased = rng.rand(n) < 0.3
+    y_true = {'orig': rng.randint(0, 2, n), 'bias': rng.randint(0, 2, n)}
+    y_pred = {'orig': rng.randint(0, 2, n), 'bias': rng.randint(0, 2, n)}
+    weight = rng.randint(1, 5, n).astype(float) if weighted else None
+
+    # Updated in uneven chunks, as evaluate_models does
+    metrics = utils.RegionMetrics()
+    bounds = [0, 7, 120, 121, 400, n]
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        metrics.update(
+                {m: y[lo:hi] for m, y in y_true.items()},
+                {m: y[lo:hi] for m, y in y_pred.items()},
+                biased[lo:hi],
+                weight=None if weight is None else weight[lo:hi])
+
+    for model in metrics.models:
+        for region, select in REGIONS.items():
+            mask = select(biased)
+            w = None if weight is None else weight[mask]
+            true, pred = y_true[model][mask], y_pred[model][mask]
+            assert metrics.accuracy(model, region) == pytest.approx(
+                    accuracy_score(true, pred, sample_weight=w))
+            assert metrics.f1(model, region) == pytest.approx(
+                    f1_score(true, pred, sample_weight=w))
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+import features
+
+# Vectorizer configurations of models.pipelines and ComplexBias (models can
+# not be imported without skorch, so they are repeated here)
+MIN_OCCURANCE = 0.01
+MAX_OCCURANCE = 1.0
+MLP_MAX_VOCAB = 100
+BIAS_MIN_DF = 0.3
+BIAS_MAX_DF = 0.5
+
+VECTORIZERS = {
+    'count_binary': lambda: CountVectorizer(
+            min_df=MIN_OCCURANCE, max_df=MAX_OCCURANCE, binary=True),
+    'bias': lambda: CountVectorizer(
+            min_df=BIAS_MIN_DF, max_df=BIAS_MAX_DF, binary=True),
+    'count_max_features': lambda: CountVectorizer(
+            min_df=2, max_df=0.9, max_features=MLP_MAX_VOCAB),
+    'tfidf': lambda: TfidfVectorizer(
+            min_df=MIN_OCCURANCE, max_df=MAX_OCCURANCE, binary=False),
+    'tfidf_max_features': lambda: TfidfVectorizer(
+            min_df=MIN_OCCURANCE, max_df=MAX_OCCURANCE,
+            max_features=MLP_MAX_VOCAB),
+    'tfidf_binary_sublinear': lambda: TfidfVectorizer(
+            min_df=3, max_df=0.8, binary=True, sublinear_tf=True),
+}
+
+
+def random_corpus(n_docs, seed):
+    # Zipf distributed words, so document frequencies span the thresholds
+    rng = np.random.RandomState(seed)
+    words = ['w{}'.format(i) for i in range(400)]
+    docs = []
+    for _ in range(n_docs):
+        ids = np.minimum(rng.zipf(1.3, size=rng.randint(5, 40)), 400) - 1
+        docs.append(' '.join(words[i] for i in ids))
+    return docs
+
+
+@pytest.mark.parametrize('name', sorted(VECTORIZERS))
+def test_matches_sklearn(name):
+    train_docs = random_corpus(300, 0)
+    test_docs = random_corpus(50, 1)
+    shared = features.SharedCounts(train_docs)
+
+    expected_vectorizer = VECTORIZERS[name]()
+    expected = expected_vectorizer.fit_transform(train_docs)
+    vectorizer = VECTORIZERS[name]()
+    got = shared.fit_transform(vectorizer, train_docs)
+
+    assert vectorizer.vocabulary_ == expected_vectorizer.vocabulary_
+    assert got.shape == expected.shape
+    assert np.allclose(got.toarray(), expected.toarray())
+
+    expected = expected_vectorizer.transform(test_docs)
+    got = shared.transform(vectorizer, test_docs)
+    assert np.allclose(got.toarray(), expected.toarray())
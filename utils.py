@@ -1,6 +1,11 @@
 import os
 import json
+import glob
 import time
+import uuid
+import random
+import socket
+import multiprocessing
 import numpy as np
 import pandas as pd
 from sklearn.base import clone
@@ -14,6 +19,11 @@ from sklearn.metrics import (
         precision_score
 )
 
+RESULTS_FILE = 'results.jsonl'  # Compacted results, under <log_dir>/<test_name>
+SHARD_DIR = 'shards'            # Per-process results waiting to be compacted
+FLUSH_ROWS = 1000               # Rows a ResultsWriter buffers before appending
+LEDGER_DIR = '.ledger'          # Completed units of sweeps, outside the results
+
 
 # Load the dataset from the given path and returned the split
 def load_dataset(data_path, train_size, runlog, quiet=False):
@@ -44,7 +54,7 @@ def oversample(train_df, r_factor=1.0, quiet=False):
     diff = int( (not_R_count - R_count) * r_factor )
     if diff > 0:
         new_examples = train_df[train_df['biased']].sample(diff, replace=True)
-        train_df = train_df.append(new_examples)
+        train_df = pd.concat([train_df, new_examples])
     else:
         assert False
 
@@ -58,7 +68,40 @@ def oversample(train_df, r_factor=1.0, quiet=False):
     return train_df
 
 
-def train_models(model_constructor, train_df, runlog, bias_only=False, quiet=False):
+# The rebalancing of oversample without copying rows, as values per row of
+# the given 'biased' column. oversample_counts is how often each row appears
+# in oversample's output, oversample_weights is its expectation (for sample
+# weights, e.g. model__sample_weight, WeightedNeuralNet or a weighted sampler)
+def oversample_counts(biased, r_factor=1.0):
+    biased = np.asarray(biased, dtype=bool)
+    diff = _oversample_diff(biased, r_factor)
+    counts = np.ones(len(biased), dtype=np.int64)
+    R_count = np.sum(biased)
+    counts[biased] += np.random.multinomial(diff, np.full(R_count, 1.0 / R_count))
+    return counts
+
+
+def oversample_weights(biased, r_factor=1.0):
+    biased = np.asarray(biased, dtype=bool)
+    diff = _oversample_diff(biased, r_factor)
+    weights = np.ones(len(biased))
+    R_count = np.sum(biased)
+    weights[biased] = (R_count + diff) / R_count
+    return weights
+
+
+def _oversample_diff(biased, r_factor):
+    R_count = np.sum(biased)
+    not_R_count = len(biased) - R_count
+    diff = int( (not_R_count - R_count) * r_factor )
+    assert diff > 0
+    return diff
+
+
+# counts is an optional fitted vectorizer to reuse (e.g. from the original
+# model, when only the stained model is retrained)
+def train_models(model_constructor, train_df, runlog, bias_only=False, quiet=False,
+        cache=None, counts=None):
     if not quiet: print('Training unbiased and biased models...')
     if not quiet: print('\tMODEL_TYPE = {}'.format(runlog['model_type']))
 
@@ -83,14 +126,27 @@ def train_models(model_constructor, train_df, runlog, bias_only=False, quiet=Fal
         pipe_orig = model_constructor()
     pipe_bias = model_constructor()
 
+    # Vectorize the reviews once (through a features.FeatureCache or
+    # SharedCounts when given), both pipelines share the fitted vectorizer and
+    # train on the same matrix
+    if counts is not None:
+        X_counts = counts.transform(X_train) if cache is None else \
+                cache.transform(counts, X_train)
+        pipe_bias.steps[0] = (pipe_bias.steps[0][0], counts)
+    else:
+        counts = pipe_bias.steps[0][1]
+        X_counts = counts.fit_transform(X_train) if cache is None else \
+                cache.fit_transform(counts, X_train)
+    if not bias_only:
+        pipe_orig.steps[0] = (pipe_orig.steps[0][0], counts)
+
     if runlog['model_type'] in ['mlp', 'lstm']:
         if not bias_only:
             model_orig = pipe_orig.steps.pop(-1)
-            pipe_orig.fit(X_train)
+            Pipeline(pipe_orig.steps[1:]).fit(X_counts)
 
         model_bias = pipe_bias.steps.pop(-1)
-        pipe_bias.fit(X_train)
-        X_train = pipe_bias.transform(X_train)
+        X_train = Pipeline(pipe_bias.steps[1:]).fit_transform(X_counts)
         X_train_bias = {
             'data': X_train,
             'sample_weight': sample_weight_orig
@@ -111,10 +167,10 @@ def train_models(model_constructor, train_df, runlog, bias_only=False, quiet=Fal
     else:
         if not bias_only:
             if not quiet: print('Training unbiased model...')
-            pipe_orig.fit(X_train, y_train_orig,
+            Pipeline(pipe_orig.steps[1:]).fit(X_counts, y_train_orig,
                     model__sample_weight=sample_weight_orig)
         if not quiet: print('Training biased model...')
-        pipe_bias.fit(X_train, y_train_bias,
+        Pipeline(pipe_bias.steps[1:]).fit(X_counts, y_train_bias,
                 model__sample_weight=sample_weight_bias)
 
     if bias_only:
@@ -123,50 +179,153 @@ def train_models(model_constructor, train_df, runlog, bias_only=False, quiet=Fal
         return pipe_orig, pipe_bias
 
 
+# Predict raw reviews with a fitted pipeline, vectorizing through the feature
+# cache (or SharedCounts) when given
+def predict(model, X, cache=None):
+    if cache is None:
+        return model.predict(X)
+    features = cache.transform(model.steps[0][1], X)
+    return Pipeline(model.steps[1:]).predict(features)
+
+
 # Split test data into R and ~R and compute the accruacies of the two models
-def evaluate_models(model_orig, model_bias, test_df, runlog, quiet=False):
+def evaluate_models(model_orig, model_bias, test_df, runlog, quiet=False,
+        cache=None):
     if not quiet: print('Evaluating unbiased and biased models on test set...')
 
     X = test_df['reviews'].values
     y_orig = test_df['label_orig'].values
     y_bias = test_df['label_bias'].values
 
-    y_pred_orig = model_orig.predict(X)
-    y_pred_bias = model_bias.predict(X)
+    y_pred_orig = predict(model_orig, X, cache)
+    y_pred_bias = predict(model_bias, X, cache)
 
     test_df['predict_orig'] = y_pred_orig
     test_df['predict_bias'] = y_pred_bias
 
-    runlog['orig_test_acc'] = accuracy_score(y_orig, y_pred_orig)
-    runlog['bias_test_acc'] = accuracy_score(y_bias, y_pred_bias)
-    runlog['orig_test_f1'] = f1_score(y_orig, y_pred_orig)
-    runlog['bias_test_f1'] = f1_score(y_bias, y_pred_bias)
-
-    mask = test_df['biased']
-    test_r = test_df[mask]
-    test_nr = test_df[~mask]
-
-    # Get original model's accuracy on R and ~R
-    y_r = test_r['label_orig'].values
-    y_nr = test_nr['label_orig'].values
-    pred_r = test_r['predict_orig'].values
-    pred_nr = test_nr['predict_orig'].values
-    orig_r_acc = accuracy_score(y_r, pred_r)
-    orig_nr_acc = accuracy_score(y_nr, pred_nr)
-
-    # Get biased model's accuracy on R and ~R
-    y_r = test_r['label_bias'].values
-    y_nr = test_nr['label_bias'].values
-    pred_r = test_r['predict_bias'].values
-    pred_nr = test_nr['predict_bias'].values
-    bias_r_acc = accuracy_score(y_r, pred_r)
-    bias_nr_acc = accuracy_score(y_nr, pred_nr)
+    # Rows oversampled by oversample_counts count as that many rows
+    weight = test_df['copies'].values if 'copies' in test_df else None
+    metrics = RegionMetrics()
+    metrics.update(
+            {'orig': y_orig, 'bias': y_bias},
+            {'orig': y_pred_orig, 'bias': y_pred_bias},
+            test_df['biased'].values,
+            weight=weight)
+
+    runlog['orig_test_acc'] = metrics.accuracy('orig')
+    runlog['bias_test_acc'] = metrics.accuracy('bias')
+    runlog['orig_test_f1'] = metrics.f1('orig')
+    runlog['bias_test_f1'] = metrics.f1('bias')
 
     # Get overall accuracy and f1-score
+    results = metrics.results()
     if not quiet: print('\t               R       !R')
-    if not quiet: print('\torig model | {:.3f} | {:.3f}'.format(orig_r_acc, orig_nr_acc))
-    if not quiet: print('\tbias model | {:.3f} | {:.3f}'.format(bias_r_acc, bias_nr_acc))
-    runlog['results'] = [[orig_r_acc, orig_nr_acc], [bias_r_acc, bias_nr_acc]]
+    if not quiet: print('\torig model | {:.3f} | {:.3f}'.format(*results[0]))
+    if not quiet: print('\tbias model | {:.3f} | {:.3f}'.format(*results[1]))
+    runlog['results'] = results
+
+
+# Accuracy and F1 of binary models, overall and on R / ~R, from confusion
+# counts. Every update is a single bincount over all models, so predictions
+# can be streamed in chunks
+class RegionMetrics:
+
+    def __init__(self, models=('orig', 'bias')):
+        self.models = list(models)
+        # model x region (~R, R) x true label x predicted label
+        self.counts = np.zeros((len(self.models), 2, 2, 2))
+
+    def update(self, y_true, y_pred, biased, weight=None):
+        # y_true and y_pred map model names to the labels of this chunk, models
+        # missing from y_pred are skipped
+        biased = np.asarray(biased, dtype=np.int64)
+        codes = []
+        for i, model in enumerate(self.models):
+            if model not in y_pred:
+                continue
+            true = np.asarray(y_true[model], dtype=np.int64)
+            pred = np.asarray(y_pred[model], dtype=np.int64)
+            codes.append(8 * i + 4 * biased + 2 * true + pred)
+        if not codes:
+            return
+        if weight is not None:
+            weight = np.tile(np.asarray(weight, dtype=np.float64), len(codes))
+        self.counts += np.bincount(np.concatenate(codes), weights=weight,
+                minlength=self.counts.size).reshape(self.counts.shape)
+
+    def _confusion(self, model, region):
+        counts = self.counts[self.models.index(model)]
+        if region is None:
+            return counts.sum(axis=0)
+        return counts[1 if region == 'R' else 0]
+
+    def accuracy(self, model, region=None):
+        # region is None (all), 'R' or 'NR'
+        confusion = self._confusion(model, region)
+        total = confusion.sum()
+        return float(np.trace(confusion) / total) if total > 0 else float('nan')
+
+    def f1(self, model, region=None):
+        confusion = self._confusion(model, region)
+        tp, fp, fn = confusion[1, 1], confusion[0, 1], confusion[1, 0]
+        return float(2 * tp / (2 * tp + fp + fn)) if tp > 0 else 0.0
+
+    def results(self):
+        # legacy (for plotting), [[R, ~R] accuracy per model]
+        return [[self.accuracy(model, 'R'), self.accuracy(model, 'NR')]
+                for model in self.models]
+
+
+# Work function shared with forked workers of map_instances
+_shared_work = None
+
+
+def instance_seed(seed, i):
+    # Independent RNG stream for instance i of a seed
+    return int(np.random.SeedSequence([seed, i]).generate_state(1)[0])
+
+
+def _run_shared(arguments):
+    i, seed = arguments
+    np.random.seed(seed)
+    random.seed(seed)
+    return _shared_work(i)
+
+
+# Returns [work(i) for i in range(n)], spread over n_workers processes. Workers
+# are forked after work is set, so whatever it closes over (e.g. a fitted
+# pipeline) is shared copy-on-write instead of pickled per instance. Each
+# instance is seeded on its own, results do not depend on n_workers
+def map_instances(work, n, seed, n_workers=1, quiet=False):
+    global _shared_work
+    arguments = [(i, instance_seed(seed, i)) for i in range(n)]
+
+    # Pool workers (e.g. one per seed) can not have children, the scripts
+    # refuse that combination so this is only reached by other callers
+    if n_workers > 1 and multiprocessing.current_process().daemon:
+        print('\tWARNING: in a daemonic pool worker, explaining {} instances '
+              'serially instead of with {} workers'.format(n, n_workers))
+        n_workers = 1
+
+    _shared_work = work
+    try:
+        if n_workers <= 1:
+            # Seeding per instance must not leak into the caller's RNGs
+            np_state = np.random.get_state()
+            py_state = random.getstate()
+            try:
+                return [_run_shared(arg) for arg in arguments]
+            finally:
+                np.random.set_state(np_state)
+                random.setstate(py_state)
+        pool = multiprocessing.get_context('fork').Pool(n_workers)
+        try:
+            return pool.map(_run_shared, arguments, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _shared_work = None
 
 
 def save_log(log_dir, runlog, quiet=False):
@@ -218,3 +377,144 @@ def save_log(log_dir, runlog, quiet=False):
     with open(log_path, 'w') as f:
         json.dump(runlog, f, indent=4)
 
+
+
+# Append-only JSON-lines store for per-example results, in place of one
+# save_log file per row. Each process appends to its own shard under
+# <log_dir>/<test_name>/shards/, flush_rows lines at a time. A run starts with
+# a single {"meta": runlog, "unit": ..., "attempt": ...} line, the rows after it
+# only hold the fields that differ from it (explainer, budget, recall, ...)
+class ResultsWriter:
+
+    def __init__(self, log_dir, test_name, flush_rows=FLUSH_ROWS, quiet=False):
+        directory = os.path.join(log_dir, test_name, SHARD_DIR)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        filename = '{}_{}.jsonl'.format(socket.gethostname(), os.getpid())
+        self.path = os.path.join(directory, filename)
+        self.flush_rows = flush_rows
+        self.quiet = quiet
+        self.meta = None
+        self.lines = []
+
+    def start_run(self, runlog, unit=None):
+        # Returns the id of this attempt at the unit, for the TaskLedger
+        attempt = uuid.uuid4().hex
+        # Round trip so later changes to runlog are not shared with meta
+        self.meta = json.loads(json.dumps(runlog))
+        self.lines.append(json.dumps(
+                {'meta': self.meta, 'unit': unit, 'attempt': attempt}))
+        return attempt
+
+    def write(self, runlog):
+        assert self.meta is not None, 'start_run must be called before write'
+        row = {key: val for key, val in runlog.items()
+                if key not in self.meta or self.meta[key] != val}
+        self.lines.append(json.dumps(row))
+        if len(self.lines) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        if not self.quiet:
+            print('Writing {} rows to: {}'.format(len(self.lines), self.path))
+        # One write per batch, a crash can only truncate the last line
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        self.lines = []
+
+    def close(self):
+        self.flush()
+
+
+# Yields the rows of a results file or shard with their run metadata merged in
+def read_results(path):
+    meta = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break   # truncated by a crash mid-write
+            record = json.loads(line)
+            if 'meta' in record:
+                meta = record['meta']
+                continue
+            row = dict(meta)
+            row.update(record)
+            yield row
+
+
+# Merge the shards of a test into <log_dir>/<test_name>/results.jsonl and
+# remove them. Given the completed units of a TaskLedger, runs of units that
+# did not complete (or were completed by another attempt) are dropped. Must not
+# run while any ResultsWriter is still writing
+def compact_results(log_dir, test_name, completed=None, quiet=False):
+    directory = os.path.join(log_dir, test_name)
+    shards = sorted(glob.glob(os.path.join(directory, SHARD_DIR, '*.jsonl')))
+    if not shards:
+        return
+
+    results_path = os.path.join(directory, RESULTS_FILE)
+    sources = shards
+    if os.path.exists(results_path):
+        sources = [results_path] + shards
+
+    tmp_path = '{}.{}.tmp'.format(results_path, os.getpid())
+    with open(tmp_path, 'w') as out:
+        for path in sources:
+            keep = True
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break   # truncated by a crash mid-write
+                    if line.startswith('{"meta"'):
+                        record = json.loads(line)
+                        unit = record.get('unit')
+                        keep = completed is None or unit is None or \
+                                completed.get(unit) == record['attempt']
+                    if keep:
+                        out.write(line)
+    os.replace(tmp_path, results_path)
+
+    for path in shards:
+        os.remove(path)
+    if not quiet:
+        print('Compacted {} shards into: {}'.format(len(shards), results_path))
+
+
+# Append-only record of the completed units of a sweep, one JSON line each.
+# Units are keyed by unit_key, a restarted sweep skips the ones recorded here
+class TaskLedger:
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}     # unit key -> attempt that completed it
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        record = json.loads(line)
+                        self.completed[record['unit']] = record['attempt']
+
+    def done(self, unit):
+        return unit in self.completed
+
+    def record(self, unit, attempt, seconds):
+        # One short append per unit, so workers of a sweep can record directly
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        line = json.dumps({'unit': unit, 'attempt': attempt, 'seconds': seconds})
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+        self.completed[unit] = attempt
+
+
+def ledger_path(log_dir, test_name):
+    # <log_dir>/.ledger/<test>.jsonl, kept out of the <log_dir>/<test> tree
+    # that plot_utils reads results from
+    return os.path.join(log_dir, LEDGER_DIR, test_name + '.jsonl')
+
+
+def unit_key(**fields):
+    return json.dumps(fields, sort_keys=True)